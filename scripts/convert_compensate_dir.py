@@ -0,0 +1,29 @@
+#!/usr/bin/python
+
+import os
+import os.path
+import sys
+
+root_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(root_path)
+
+from trap_dc import solutions
+
+if len(sys.argv) != 3:
+    print(f'''
+Convert a directory of voltage solutions with one file per position
+to a single solution store file.
+
+Usage:
+
+    {sys.argv[0]} solution_dir output_file
+
+Arguments:
+
+    solution_dir: the directory with one solution file per position,
+        e.g. `data/compensate_red_20221222`.
+
+    output_file: the HDF5 file to write.''')
+    exit(1)
+
+solutions.convert_compensate_dir(sys.argv[1], sys.argv[2])
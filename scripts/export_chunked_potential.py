@@ -0,0 +1,34 @@
+#!/usr/bin/python
+
+import os
+import os.path
+import sys
+
+root_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+data_path = os.path.join(root_path, "data")
+sys.path.append(root_path)
+
+from trap_dc import solutions, potentials
+
+if len(sys.argv) != 3:
+    print(f'''
+Convert a Sandia potential file to the chunked HDF5 format,
+taken into account known shorted electrodes as of Dec. 2022.
+
+Usage:
+
+    {sys.argv[0]} potential_file output_file
+
+Arguments:
+
+    potential_file: the voltage solution file provided by Sandia.
+
+    output_file: the HDF5 file to write.''')
+    exit(1)
+
+short_map = solutions.load_short_map(
+    os.path.join(data_path, "electrode_short_red_202212.csv"))
+
+potential = potentials.Potential.load(sys.argv[1], aliases=short_map,
+                                      mmap=True, lazy=True, max_cached=1)
+potential.export_chunked(sys.argv[2], compression="gzip")
@@ -4,58 +4,49 @@ import os
 import os.path
 import sys
 
-import h5py
-import json
-import numpy as np
-
 root_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 data_path = os.path.join(root_path, "data")
 sys.path.append(root_path)
 
-from trap_dc import solutions, potentials
+from trap_dc import fitting, solutions, potentials
 
 centers = solutions.CenterTracker(trap="phoenix")
 short_map = solutions.load_short_map(
     os.path.join(data_path, "electrode_short_red_202212.csv"))
 
-if len(sys.argv) != 2:
+if len(sys.argv) not in (2, 3):
     print(f'''
 Example script to calculate a set of voltage solutions for the red chamber,
 taken into account known shorted electrodes as of Dec. 2022.
 
 Usage:
 
-    {sys.argv[0]} potential_file
+    {sys.argv[0]} potential_file [workers]
 
 Arguments:
 
-    potential_file: the voltage solution file provided by Sandia.''')
+    potential_file: the voltage solution file provided by Sandia.
+
+    workers: the number of worker processes (default to one per core).
+
+Positions that are already in the solution store are skipped.''')
     exit(1)
 
 potential_file = sys.argv[1]
+workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
 potential = potentials.Potential.import_64(potential_file, aliases=short_map)
-fits_cache = solutions.compensate_fitter3(potential)
-
-prefix_dir = os.path.join(data_path, "compensate_red_20221222")
-os.makedirs(prefix_dir, exist_ok=True)
-
-def get_rf_center(xpos_um):
-    xidx = potential.x_axis_to_index(xpos_um / 1000)
-    return (xidx, *centers.get(xidx))
-
-def get_compensate_solution(xpos_um):
-    print(f"xpos_um={xpos_um}")
-    return solutions.solve_compensate1(fits_cache, get_rf_center(xpos_um),
-                                       electrode_min_num=12,
-                                       electrode_min_dist=210)
+# Same fitter as `solutions.compensate_fitter3`
+fitter = fitting.get_fitter((8, 2, 2), sizes=(77, 5, 5))
 
 xpos_ums = range(-500, 501)
-electrode_names_json = json.dumps(potential.electrode_names)
-for xpos_um in xpos_ums:
-    eles, voltages = get_compensate_solution(xpos_um)
-    with h5py.File(os.path.join(prefix_dir, f"{xpos_um}.h5"), 'w') as fh:
-        fh.create_dataset("electrode_names", data=electrode_names_json)
-        fh.create_dataset("electrodes", data=eles)
-        g = fh.create_group("solutions")
-        for name in voltages._fields:
-            g.create_dataset(name, data=getattr(voltages, name))
+store = solutions.SolutionStore.open_or_create(
+    os.path.join(data_path, "compensate_red_20221222.h5"), xpos_ums,
+    potential.electrode_names, solutions.CompensateTerms1._fields)
+try:
+    solutions.generate_compensate(potential, fitter, centers, xpos_ums, store,
+                                  electrode_min_num=12, electrode_min_dist=210,
+                                  workers=workers)
+finally:
+    store.close()
+    if potential.shared_memory is not None:
+        potential.close_shared_memory(unlink=True)
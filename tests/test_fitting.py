@@ -136,6 +136,52 @@ def test_fitresult_eval():
         for y in np.arange(-2, 2.1, 0.25):
             assert res2(x, y) == 1 + 2 * y**2 - x + 3 * x * y**2 + 0.5 * x**2 * y
 
+def test_fitresult_evaluate():
+    # x^2 + xy - 3x^2y^2 - y
+    res2 = fitting.PolyFitResult((2, 2), np.array([0.0, -1, 0, # y^n
+                                                   0, 1, 0, # x * y^n
+                                                   1, 0, -3])) # x^2 * y^n
+    x, y = np.meshgrid(np.arange(-2, 2.1, 0.25), np.arange(-2, 2.1, 0.25),
+                       indexing='ij')
+    x = x.reshape(-1)
+    y = y.reshape(-1)
+    pts = np.stack([x, y], axis=1)
+    vals = res2.evaluate(pts)
+    assert vals.shape == (len(x),)
+    assert vals == pytest.approx(x**2 + x * y - 3 * x**2 * y**2 - y)
+    vals2, grad = res2.evaluate(pts, gradient=True)
+    assert (vals2 == vals).all()
+    assert grad.shape == (len(x), 2)
+    assert grad[:, 0] == pytest.approx(2 * x + y - 6 * x * y**2)
+    assert grad[:, 1] == pytest.approx(x - 6 * x**2 * y - 1)
+    vals3, grad3, hess = res2.evaluate(pts, gradient=True, hessian=True)
+    assert (vals3 == vals).all()
+    assert (grad3 == grad).all()
+    assert hess.shape == (len(x), 2, 2)
+    assert hess[:, 0, 0] == pytest.approx(2 - 6 * y**2)
+    assert hess[:, 0, 1] == pytest.approx(1 - 12 * x * y)
+    assert hess[:, 1, 0] == pytest.approx(1 - 12 * x * y)
+    assert hess[:, 1, 1] == pytest.approx(-6 * x**2)
+    vals4, hess4 = res2.evaluate(pts, hessian=True)
+    assert (vals4 == vals).all()
+    assert (hess4 == hess).all()
+
+    rng = np.random.default_rng(9753)
+    res3 = fitting.PolyFitResult((4, 2, 3), rng.normal(size=60))
+    pts = rng.uniform(-1, 1, size=(20, 3))
+    vals, grad, hess = res3.evaluate(pts, gradient=True, hessian=True)
+    for (i, pt) in enumerate(pts):
+        assert vals[i] == pytest.approx(res3(*pt))
+        for dim in range(3):
+            assert grad[i, dim] == pytest.approx(res3.gradient(dim, pt))
+            for dim2 in range(3):
+                order = [0, 0, 0]
+                order[dim] += 1
+                order[dim2] += 1
+                factor = 2 if dim == dim2 else 1
+                assert (hess[i, dim, dim2] == pytest.approx(
+                    res3._shifted_coefficient(pt, order) * factor))
+
 def test_fitresult_shift():
     res1 = fitting.PolyFitResult((3,), np.array([1.0, -1, 0, 1]))
     for x in np.arange(-2, 2.1, 0.25):
@@ -163,6 +209,31 @@ def test_fitresult_shift():
         for y in np.arange(-2, 2.1, 0.25):
             assert res2_4(x - 3, y + 1.25) == x**2 + x * y - 3 * x**2 * y**2 - y
 
+def test_fitresult_shift_matrix():
+    rng = np.random.default_rng(1357)
+    res = fitting.PolyFitResult((4, 2, 3), rng.normal(size=60))
+    pts = rng.uniform(-1, 1, size=(5, 3))
+    for shift in [(0, 0, 0), (0.5, -0.25, 1.5), (-2, 1, 0)]:
+        shifted = res.shift(shift)
+        for pt in pts:
+            assert shifted(*pt) == pytest.approx(res(*(pt + shift)))
+        for order in fitting.CartesianIndices((5, 3, 4)):
+            assert (res._shifted_coefficient(shift, order) ==
+                        pytest.approx(shifted[order]))
+
+    # Shifting a stack of coefficients
+    coefficients = rng.normal(size=(6, 60))
+    shifts = rng.uniform(-2, 2, size=(6, 3))
+    stacked = fitting._shift_coefficient((4, 2, 3), coefficients, shifts)
+    assert stacked.shape == (6, 60)
+    for i in range(6):
+        expected = fitting.PolyFitResult((4, 2, 3), coefficients[i]).shift(shifts[i])
+        assert stacked[i] == pytest.approx(expected.coefficient)
+    stacked = fitting._shift_coefficient((4, 2, 3), coefficients, shifts[0])
+    for i in range(6):
+        expected = fitting.PolyFitResult((4, 2, 3), coefficients[i]).shift(shifts[0])
+        assert stacked[i] == pytest.approx(expected.coefficient)
+
 def test_fitter():
     fitter1 = fitting.PolyFitter((2,))
     x1 = np.array([-1, 0, 1])
@@ -253,6 +324,118 @@ def test_fitter():
                 else:
                     assert c == pytest.approx(0, abs=1e-5)
 
+def test_fitter_many():
+    fitter1 = fitting.PolyFitter((4,), sizes=(11,))
+    x1 = np.arange(-5, 6)
+    ys = np.array([1 - x1 * 2 + x1**2 / 3 + 0.4 * x1**4,
+                   2 + x1 - x1**3 / 5,
+                   np.cos(x1 / 3)])
+    res1 = fitter1.fit_many(ys)
+    assert res1.shape == (3, 5)
+    assert res1[0] == pytest.approx([1, -2, 1 / 3, 0, 0.4])
+    assert res1[1] == pytest.approx([2, 1, 0, -0.2, 0])
+    for i in range(3):
+        assert res1[i] == pytest.approx(fitter1.fit(ys[i]).coefficient)
+
+    fitter2 = fitting.PolyFitter((2, 3), sizes=(5, 7))
+    rng = np.random.default_rng(1234)
+    vs = rng.normal(size=(2, 3, 5, 7))
+    res2 = fitter2.fit_many(vs)
+    assert res2.shape == (2, 3, 12)
+    for i in range(2):
+        for j in range(3):
+            expected = np.linalg.lstsq(fitter2.coefficient, vs[i, j].reshape(-1),
+                                       rcond=None)[0] * fitter2.scales
+            assert res2[i, j] == pytest.approx(expected)
+            assert fitter2.fit(vs[i, j]).coefficient == pytest.approx(expected)
+
+def test_separable_fitter():
+    rng = np.random.default_rng(4321)
+    for (orders, sizes, center) in [((4,), (11,), None),
+                                    ((2, 3), (5, 7), (1.5, 4)),
+                                    ((4, 2, 2), (129, 5, 5), None),
+                                    ((8, 2, 2), (77, 5, 5), (30, 2, 2.5))]:
+        dense = fitting.PolyFitter(orders, sizes=sizes, center=center,
+                                   separable=False)
+        separable = fitting.PolyFitter(orders, sizes=sizes, center=center)
+        assert separable.separable
+        assert not dense.separable
+        assert separable.projection == pytest.approx(dense.projection, abs=1e-10)
+        vs = rng.normal(size=(3, *sizes))
+        many = separable.fit_many(vs)
+        for i in range(3):
+            expected = dense.fit(vs[i]).coefficient
+            assert separable.fit(vs[i]).coefficient == pytest.approx(expected,
+                                                                     abs=1e-10)
+            assert many[i] == pytest.approx(expected, abs=1e-10)
+
+def test_fitter_registry():
+    fitter1 = fitting.get_fitter((4, 2, 2), sizes=(129, 5, 5))
+    assert fitting.get_fitter((4, 2, 2), sizes=(129, 5, 5)) is fitter1
+    assert fitting.get_fitter([4, 2, 2], sizes=np.array([129, 5, 5])) is fitter1
+    assert fitting.get_fitter((4, 2, 2), sizes=(77, 5, 5)) is not fitter1
+    assert fitting.get_fitter((3, 3)) is fitting.get_fitter((3, 3), sizes=(4, 4))
+    fitter2 = fitting.get_fitter((3,), sizes=(9,), center=(2.5,))
+    assert fitter2 is not fitting.get_fitter((3,), sizes=(9,))
+    assert (fitter2.center == [2.5]).all()
+
+    # The vectorized construction should match the definition of the terms.
+    ref = fitting.PolyFitter((4, 2, 2), sizes=(9, 5, 3), center=(3, 2.5, 0.5))
+    x, y, z = np.meshgrid(np.arange(9) - 3, np.arange(5) - 2.5, np.arange(3) - 0.5,
+                          indexing='ij')
+    scale_max = np.maximum((np.array([9, 5, 3]) - 1) / 2, 1)
+    for order in fitting.CartesianIndices((5, 3, 3)):
+        iorder = fitting.LinearIndices((5, 3, 3))[order]
+        scale = 1 / np.prod(scale_max**np.array(order))
+        assert ref.scales[iorder] == pytest.approx(scale)
+        expected = x**order[0] * y**order[1] * z**order[2] * scale
+        assert ref.coefficient[:, iorder] == pytest.approx(expected.reshape(-1))
+
+def test_fit_field():
+    rng = np.random.default_rng(2468)
+    fitter1 = fitting.PolyFitter((3,), sizes=(7,))
+    v1 = rng.normal(size=30)
+    field1 = fitter1.fit_field(v1)
+    assert field1.shape == (24, 4)
+    for i in range(24):
+        assert field1[i] == pytest.approx(fitter1.fit(v1[i:i + 7]).coefficient)
+
+    fitter3 = fitting.PolyFitter((4, 2, 2), sizes=(11, 5, 3))
+    v3 = rng.normal(size=(30, 8, 9))
+    field3 = fitter3.fit_field(v3)
+    assert field3.shape == (20, 4, 7, 45)
+    for (i, j, k) in [(0, 0, 0), (19, 3, 6), (5, 2, 1), (13, 0, 4)]:
+        expected = fitter3.fit(v3[i:i + 11, j:j + 5, k:k + 3]).coefficient
+        assert field3[i, j, k] == pytest.approx(expected)
+
+    field3_x = fitter3.fit_field(v3, axes=(0,), starts=(None, 2, 5))
+    assert field3_x.shape == (20, 45)
+    field3_xz = fitter3.fit_field(v3, axes=(2, 0), starts=(None, 1, None))
+    assert field3_xz.shape == (20, 7, 45)
+    for i in range(20):
+        assert field3_x[i] == pytest.approx(field3[i, 2, 5])
+        for k in range(7):
+            assert field3_xz[i, k] == pytest.approx(field3[i, 1, k])
+
+    fit_cache = fitting.PolyFitCache(fitter3, v3)
+    fit_cache.fill_field(axes=(0,), starts=fit_cache.fit_index((0, 4, 6)))
+    assert fit_cache.field.shape == (20, 45)
+    for xpos in np.linspace(-3, 33, 20):
+        # Covered by the field
+        fit = fit_cache.get((xpos, 4.2, 6.1))
+        ref = fitter3.fit(v3[fit_cache.fit_index((xpos, 4, 6))[0]:][:11, 2:7, 5:8])
+        shift = (xpos - fit_cache.fit_index((xpos, 4, 6))[0] - 5, 0.2, 0.1)
+        assert fit.coefficient == pytest.approx(ref.shift(shift).coefficient)
+        # Not covered by the field
+        fit = fit_cache.get((xpos, 1, 2))
+        idx = fit_cache.fit_index((xpos, 1, 2))
+        ref = fitter3.fit(v3[idx[0]:idx[0] + 11, idx[1]:idx[1] + 5,
+                             idx[2]:idx[2] + 3])
+        shift = np.array((xpos, 1, 2)) - idx - (np.array((11, 5, 3)) - 1) / 2
+        assert fit.coefficient == pytest.approx(ref.shift(shift).coefficient)
+    assert len(fit_cache.cache) > 0
+    assert all(idx[1:] != (2, 5) for idx in fit_cache.cache)
+
 def test_fit_cache():
     def check_fit(fit_cache, pos, **kwargs):
         fit = fit_cache.get(pos, **kwargs)
@@ -301,6 +484,134 @@ def test_fit_cache():
                 for yfit_center in np.linspace(-10, 110, 7):
                     check_fit2(xpos, ypos, fit_center=(xfit_center, yfit_center))
 
+def test_fit_cache_many():
+    fitter = fitting.PolyFitter((4, 2, 2), sizes=(11, 5, 5))
+    rng = np.random.default_rng(8642)
+    v = rng.normal(size=(40, 9, 9))
+    fit_cache = fitting.PolyFitCache(fitter, v)
+    pos = np.stack([np.linspace(-3, 43, 50), rng.uniform(0, 8, 50),
+                    rng.uniform(0, 8, 50)], axis=1)
+    res = fit_cache.get_many(pos)
+    assert res.shape == (50, 45)
+    # Each distinct window is fitted once
+    assert len(fit_cache.cache) == len(set(fit_cache.fit_index(p) for p in pos))
+    for i in range(50):
+        assert res[i] == pytest.approx(fit_cache.get(pos[i]).coefficient)
+
+    fit_center = pos[::-1]
+    res = fit_cache.get_many(pos, fit_center=fit_center)
+    for i in range(50):
+        expected = fit_cache.get(pos[i], fit_center=fit_center[i]).coefficient
+        assert res[i] == pytest.approx(expected)
+
+    res = fit_cache.get_many(pos[0])
+    assert res.shape == (1, 45)
+    assert res[0] == pytest.approx(fit_cache.get(pos[0]).coefficient)
+
+def test_fit_cache_budget():
+    fitter = fitting.PolyFitter((2,), sizes=(5,))
+    v = np.arange(100.0)**2
+    fit_cache = fitting.PolyFitCache(fitter, v, max_entries=3)
+    for pos in (10, 20, 30):
+        fit_cache.get((pos,))
+    assert len(fit_cache.cache) == 3
+    assert len(fit_cache.budget) == 3
+    # Touch the oldest one so that the second one gets evicted
+    fit_cache.get((10,))
+    fit_cache.get((40,))
+    assert sorted(fit_cache.cache) == [(8,), (28,), (38,)]
+    assert fit_cache.get((20,))(0) == pytest.approx(400)
+    assert sorted(fit_cache.cache) == [(8,), (18,), (38,)]
+    fit_cache.clear()
+    assert len(fit_cache.cache) == 0
+    assert len(fit_cache.budget) == 0
+    assert fit_cache.budget.nbytes == 0
+
+    nbytes = fitter.fit(v[:5]).coefficient.nbytes
+    budget = fitting.CacheBudget(max_bytes=nbytes * 4)
+    fit_cache1 = fitting.PolyFitCache(fitter, v, budget=budget)
+    fit_cache2 = fitting.PolyFitCache(fitter, -v, budget=budget)
+    for pos in (10, 20, 30):
+        fit_cache1.get((pos,))
+        fit_cache2.get((pos,))
+    assert len(budget) == 4
+    assert budget.nbytes == nbytes * 4
+    assert sorted(fit_cache1.cache) == [(18,), (28,)]
+    assert sorted(fit_cache2.cache) == [(18,), (28,)]
+    # Results should still be correct after eviction
+    assert fit_cache2.get_single((10,), (0,)) == pytest.approx(-100)
+    assert fit_cache1.get_single((10,), (0,)) == pytest.approx(100)
+    assert sorted(fit_cache1.cache) == [(8,), (28,)]
+    assert sorted(fit_cache2.cache) == [(8,), (28,)]
+    assert len(budget) == 4
+    assert budget.nbytes == nbytes * 4
+
+def test_fit_cache_threads():
+    import concurrent.futures
+    import threading
+
+    class CountingFitter(fitting.PolyFitter):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.nfits = 0
+            self.lock = threading.Lock()
+        def fit(self, data):
+            with self.lock:
+                self.nfits += 1
+            return super().fit(data)
+
+    fitter = CountingFitter((2,), sizes=(5,))
+    v = np.arange(200.0)**2
+    fit_cache = fitting.PolyFitCache(fitter, v)
+    positions = np.tile(np.arange(2, 198), 8)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        res = list(pool.map(lambda pos: fit_cache.get_single((pos,), (0,)),
+                            positions))
+    assert res == pytest.approx(positions**2)
+    # Each window is only fitted once
+    assert fitter.nfits == 196
+    assert len(fit_cache.cache) == 196
+
+    budget = fitting.CacheBudget(max_entries=10)
+    fit_cache1 = fitting.PolyFitCache(fitter, v, budget=budget)
+    fit_cache2 = fitting.PolyFitCache(fitter, -v, budget=budget)
+    def get(pos):
+        return (fit_cache1.get_single((pos,), (0,)),
+                fit_cache2.get_single((pos,), (0,)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        res = np.array(list(pool.map(get, positions)))
+    assert res[:, 0] == pytest.approx(positions**2)
+    assert res[:, 1] == pytest.approx(-positions**2)
+    assert len(budget) == 10
+    assert len(fit_cache1.cache) + len(fit_cache2.cache) == 10
+
+    # Replacing the field while other threads are looking up fits
+    rng = np.random.default_rng(1122)
+    v3 = rng.normal(size=(30, 8, 9))
+    fitter3 = fitting.PolyFitter((4, 2, 2), sizes=(11, 5, 3))
+    fit_cache = fitting.PolyFitCache(fitter3, v3)
+    ref_cache = fitting.PolyFitCache(fitter3, v3)
+    points = [(x, y, z) for x in np.linspace(0, 29, 8) for y in (1, 4, 6)
+              for z in (0.5, 6)]
+    expected = [ref_cache.get(p).coefficient for p in points]
+    stop = threading.Event()
+    def fill():
+        while not stop.is_set():
+            for starts in ((None, 1, 5), (None, 3, 2), (4, 1, None)):
+                axes = tuple(i for i in range(3) if starts[i] is None)
+                fit_cache.fill_field(axes=axes, starts=starts)
+    filler = threading.Thread(target=fill)
+    filler.start()
+    try:
+        for i in range(5):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+                res = list(pool.map(lambda p: fit_cache.get(p).coefficient, points))
+            for (r, e) in zip(res, expected):
+                assert r == pytest.approx(e)
+    finally:
+        stop.set()
+        filler.join()
+
 def test_gradient():
     # 1 + 2x + x^3
     res1 = fitting.PolyFitResult((3,), np.array([1.0, 2, 0, 1]))
@@ -352,3 +663,59 @@ def test_gradient():
                         pytest.approx(f2_dx(xpos, ypos)))
             assert (fit_cache2.gradient(1, (xpos, ypos)) ==
                         pytest.approx(f2_dy(xpos, ypos)))
+
+def test_gradient_hessian():
+    fitter2 = fitting.PolyFitter((4, 5), sizes=(11, 20))
+    x2, y2 = np.meshgrid(np.arange(30), np.arange(100), indexing='ij')
+    def f2(x, y):
+        x = x - 15
+        y = y - 50
+        return (1 + x + y / 2 + x * y + x**2 / 3 + (x / 5)**2 * (y / 10)**3)
+    v2 = f2(x2, y2)
+    fit_cache2 = fitting.PolyFitCache(fitter2, v2)
+    for xpos in np.linspace(-5, 35, 9):
+        for ypos in np.linspace(-10, 110, 9):
+            grad, hess = fit_cache2.gradient_hessian((xpos, ypos))
+            assert grad.shape == (2,)
+            assert hess.shape == (2, 2)
+            assert grad[0] == pytest.approx(fit_cache2.gradient(0, (xpos, ypos)))
+            assert grad[1] == pytest.approx(fit_cache2.gradient(1, (xpos, ypos)))
+            x = xpos - 15
+            y = ypos - 50
+            assert hess[0, 0] == pytest.approx(2 / 3 + 2 / 25 * (y / 10)**3)
+            assert hess[0, 1] == pytest.approx(1 + 6 / 50 * (x / 5) * (y / 10)**2)
+            assert hess[1, 0] == pytest.approx(hess[0, 1])
+            assert hess[1, 1] == pytest.approx(6 / 100 * (x / 5)**2 * (y / 10))
+
+def test_fit_cache_float32():
+    fitter = fitting.PolyFitter((4, 2, 2), sizes=(21, 5, 5))
+    x, y, z = np.meshgrid(np.arange(60), np.arange(9), np.arange(8), indexing='ij')
+    v = np.sin(x / 7) * np.cos((y - 4) / 5) + (z - 3.5)**2 / 10 + x * y / 50
+    v32 = v.astype(np.float32)
+    fit_cache = fitting.PolyFitCache(fitter, v)
+    fit_cache32 = fitting.PolyFitCache(fitter, v32, dtype=np.float32)
+    eps = 2.0**-24
+    for pos in [(0, 0, 0), (12.3, 4.1, 3.9), (33, 2.5, 6), (59, 8, 7)]:
+        fit = fit_cache.get(pos)
+        fit32 = fit_cache32.get(pos)
+        assert fit32.coefficient.dtype == np.float64
+        idx = fit_cache.fit_index(pos)
+        assert fit_cache32.cache[idx].coefficient.dtype == np.float32
+        # Error bound before the shift
+        window = v[idx[0]:idx[0] + 21, idx[1]:idx[1] + 5, idx[2]:idx[2] + 5]
+        raw = fit_cache.cache[idx].coefficient
+        raw32 = fit_cache32.cache[idx].coefficient
+        bound = fitter.error_bound(np.abs(window).max(), eps) + np.abs(raw) * eps
+        assert (np.abs(raw32 - raw) <= bound).all()
+        # Propagated through the shift
+        shift = np.array(pos) - idx - (fitter.sizes - 1) / 2
+        shift_mat = fitting._shift_coefficient(fitter.orders, np.eye(45), shift).T
+        assert (np.abs(fit32.coefficient - fit.coefficient) <=
+                    np.abs(shift_mat) @ bound * (1 + 1e-10)).all()
+
+    fit_cache32.fill_field(axes=(0,), starts=(None, 2, 1))
+    assert fit_cache32.field.dtype == np.float32
+    assert (fit_cache32.get((10, 4.2, 3)).coefficient ==
+                pytest.approx(fit_cache.get((10, 4.2, 3)).coefficient, rel=1e-5,
+                              abs=1e-5))
+
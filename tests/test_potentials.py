@@ -0,0 +1,440 @@
+#!/usr/bin/python
+
+from trap_dc import fitting, potentials
+
+import numpy as np
+import os
+import pytest
+import struct
+import subprocess
+import sys
+import weakref
+
+def write_potential(filename, version, data, stride, origin):
+    # Write a potential file in the format used by Sandia.
+    # stride and origin are in mm.
+    electrodes, nx, ny, nz = data.shape
+    stride_m = tuple(s / 1000 for s in stride)
+    origin_m = tuple(o / 1000 for o in origin)
+    with open(filename, 'wb') as fh:
+        if version == '64':
+            fh.write(struct.pack('<Q', 0))
+            fh.write(struct.pack('<5Q', electrodes, nx, ny, nz, 1))
+            fh.write(struct.pack('<6d', 1, 0, 0, 0, 1, 0))
+            fh.write(struct.pack('<3d', *stride_m))
+            fh.write(struct.pack('<3d', *origin_m))
+            fh.write(struct.pack('<2Q', 0, 0))
+            fh.write(np.arange(electrodes, dtype='<Q').tobytes())
+        else:
+            fh.write(struct.pack('<I', 0))
+            fh.write(struct.pack('<5I', electrodes, nx, ny, nz, 1))
+            if version == 'v1':
+                fh.write(struct.pack('<6d', 1, 0, 0, 0, 1, 0))
+            else:
+                assert version == 'v0'
+            fh.write(struct.pack('<3d', *stride_m))
+            fh.write(struct.pack('<3d', *origin_m))
+            fh.write(struct.pack('<2I', 0, 0))
+            fh.write(np.arange(electrodes, dtype='<I').tobytes())
+        fh.write(np.asarray(data, dtype='<d').tobytes())
+
+def random_data(seed=1234, shape=(8, 6, 5)):
+    rng = np.random.default_rng(seed)
+    nelectrodes = len(potentials._raw_electrode_names("phoenix"))
+    return rng.normal(size=(nelectrodes, *shape))
+
+def check_potential(potential, data, stride, origin):
+    assert potential.electrodes == data.shape[0]
+    assert (potential.nx, potential.ny, potential.nz) == data.shape[1:]
+    assert potential.stride == pytest.approx(stride)
+    assert potential.origin == pytest.approx(origin)
+    assert potential.data.shape == data.shape
+    assert (np.asarray(potential.data) == data).all()
+
+@pytest.mark.parametrize("version", ['v0', 'v1', '64'])
+def test_import(tmp_path, version):
+    data = random_data()
+    stride = (0.005, 0.002, 0.003)
+    origin = (-1.2, -0.01, 0.05)
+    fname = tmp_path / f"potential_{version}.bin"
+    write_potential(fname, version, data, stride, origin)
+    importer = getattr(potentials.Potential, f"import_{version}")
+
+    potential = importer(fname)
+    check_potential(potential, data, stride, origin)
+    assert not isinstance(potential.data, np.memmap)
+    assert potential.electrode_index["GND"] == 0
+    assert potential.electrode_index["Q10"] == potential.electrode_names.index(["Q10"])
+
+    potential = importer(fname, mmap=True)
+    check_potential(potential, data, stride, origin)
+    assert isinstance(potential.data, np.memmap)
+    assert not potential.data.flags.writeable
+
+    potential = potentials.Potential.load(fname)
+    assert potential.version == version
+    check_potential(potential, data, stride, origin)
+    assert not isinstance(potential.data, np.memmap)
+    potential = potentials.Potential.load(fname, mmap=True)
+    assert potential.version == version
+    check_potential(potential, data, stride, origin)
+    assert isinstance(potential.data, np.memmap)
+    potential = potentials.RawPotential.load(fname)
+    assert potential.version == version
+    check_potential(potential, data, stride, origin)
+    assert len(potential.electrodemapping) == data.shape[0]
+
+    aliases = {"Q1": "Q0", "Q3": "GND"}
+    potential = importer(fname, aliases=aliases, mmap=True)
+    assert potential.electrodes == data.shape[0] - 2
+    q0 = potential.electrode_index["Q0"]
+    assert potential.electrode_index["Q1"] == q0
+    assert potential.electrode_index["Q3"] == 0
+    raw_index = potentials._raw_electrode_index("phoenix")
+    assert (np.asarray(potential.data[q0]) ==
+                data[raw_index["Q0"]] + data[raw_index["Q1"]]).all()
+    assert (np.asarray(potential.data[0]) ==
+                data[raw_index["GND"]] + data[raw_index["Q3"]]).all()
+
+    # Truncated file
+    with open(fname, 'r+b') as fh:
+        fh.truncate(fname.stat().st_size - 8)
+    with pytest.raises(ValueError):
+        importer(fname)
+    with pytest.raises(ValueError):
+        importer(fname, mmap=True)
+    with pytest.raises(ValueError):
+        potentials.Potential.load(fname)
+
+def test_lazy_alias(tmp_path):
+    data = random_data(seed=4321)
+    fname = tmp_path / "potential.bin"
+    write_potential(fname, '64', data, (0.005, 0.002, 0.003), (-1, 0, 0))
+    raw_index = potentials._raw_electrode_index("phoenix")
+    aliases = {"Q1": "Q0", "Q2": "Q0", "S3": "GND"}
+    ref = potentials.Potential.import_64(fname, aliases=aliases)
+    assert isinstance(ref.data, np.ndarray)
+    for mmap in (False, True):
+        potential = potentials.Potential.import_64(fname, aliases=aliases, mmap=mmap,
+                                                   lazy=True, max_cached=3)
+        assert isinstance(potential.data, potentials.LazyElectrodeData)
+        assert potential.data.shape == ref.data.shape
+        assert len(potential.data) == potential.electrodes
+        assert potential.data.cached == []
+        q0 = potential.electrode_index["Q0"]
+        assert (potential.data[q0] == data[raw_index["Q0"]] + data[raw_index["Q1"]]
+                    + data[raw_index["Q2"]]).all()
+        assert potential.data.cached == [q0]
+        assert (potential.data[q0, 1:3, :, 2] == ref.data[q0, 1:3, :, 2]).all()
+        assert (potential.data[5, :, :, :] == ref.data[5]).all()
+        assert (potential.data[0] == data[0] + data[raw_index["S3"]]).all()
+        assert potential.data.cached == [q0, 5, 0]
+        assert (potential.data[-1] == ref.data[-1]).all()
+        assert potential.data.cached == [5, 0, potential.electrodes - 1]
+        potential.data.evict(5)
+        assert potential.data.cached == [0, potential.electrodes - 1]
+        assert (potential.data[2:6, 1] == ref.data[2:6, 1]).all()
+        potential.data.evict()
+        assert potential.data.cached == []
+        assert (np.asarray(potential.data) == ref.data).all()
+        assert potential.data.cached == []
+
+        fitter = fitting.PolyFitter((2, 2, 2), sizes=(5, 5, 5))
+        fit_cache = potential.get_cache(fitter)
+        fit_cache_ref = ref.get_cache(fitter)
+        pos = (3.2, 2.5, 1.7)
+        assert (fit_cache.get("Q2", pos).coefficient ==
+                    pytest.approx(fit_cache_ref.get("Q2", pos).coefficient))
+
+        # The fit cache doesn't keep the data of the evicted electrodes alive
+        loaded = []
+        load = potential.data._load
+        def _load(ele):
+            res = load(ele)
+            loaded.append(weakref.ref(res))
+            return res
+        potential.data._load = _load
+        potential.data.evict()
+        for ele in range(10):
+            assert (fit_cache.get(ele, pos).coefficient ==
+                        pytest.approx(fit_cache_ref.get(ele, pos).coefficient))
+        assert len(loaded) == 10
+        assert len(potential.data.cached) == 3
+        assert sum(ref() is not None for ref in loaded) == 3
+
+def test_chunked(tmp_path):
+    data = random_data(seed=5678, shape=(20, 6, 5))
+    fname = tmp_path / "potential.bin"
+    stride = (0.005, 0.002, 0.003)
+    origin = (-1, 0.1, 0.2)
+    write_potential(fname, '64', data, stride, origin)
+    aliases = {"Q1": "Q0", "S3": "GND"}
+    ref = potentials.Potential.import_64(fname, aliases=aliases)
+    for compression in (None, "gzip"):
+        h5name = tmp_path / f"potential_{compression}.h5"
+        ref.export_chunked(h5name, chunk_x=8, compression=compression)
+        potential = potentials.Potential.import_chunked(h5name)
+        assert potential.electrode_names == ref.electrode_names
+        assert potential.electrode_index == ref.electrode_index
+        check_potential(potential, ref.data, stride, origin)
+
+        q0 = ref.electrode_index["Q0"]
+        potential = potentials.Potential.import_chunked(h5name, electrodes=["Q0", 3],
+                                                        x_range=(4, 15))
+        assert sorted(potential.data.cached) == sorted([3, q0])
+        assert potential.nx == 11
+        assert potential.origin == pytest.approx((-1 + 4 * 0.005, 0.1, 0.2))
+        assert potential.x_index_to_axis(0) == pytest.approx(ref.x_index_to_axis(4))
+        check_potential(potential, ref.data[:, 4:15], stride, potential.origin)
+        assert (potential.data[q0] == ref.data[q0, 4:15]).all()
+        fh = potential.file
+        potential.close()
+        assert potential.file is None
+        assert not fh
+
+    # Export from lazy data
+    lazy = potentials.Potential.import_64(fname, aliases=aliases, lazy=True,
+                                          max_cached=2)
+    h5name = tmp_path / "potential_lazy.h5"
+    lazy.export_chunked(h5name)
+    with potentials.Potential.import_chunked(h5name, x_range=(-5, None)) as potential:
+        check_potential(potential, ref.data[:, -5:], stride, potential.origin)
+        fh = potential.file
+        assert fh
+    assert not fh
+
+@pytest.mark.parametrize("version", ['v0', 'v1', '64'])
+def test_crop(tmp_path, version):
+    data = random_data(seed=2468, shape=(20, 9, 7))
+    stride = (0.005, 0.002, 0.003)
+    origin = (-1, 0.1, 0.2)
+    fname = tmp_path / "potential.bin"
+    write_potential(fname, version, data, stride, origin)
+    aliases = {"Q1": "Q0", "S3": "GND"}
+    ref = getattr(potentials.Potential, f"import_{version}")(fname, aliases=aliases)
+
+    crop = ((3, 15), (2, None), (None, -2))
+    cropped_origin = (-1 + 3 * 0.005, 0.1 + 2 * 0.002, 0.2)
+    for mmap in (False, True):
+        for lazy in (False, True):
+            potential = potentials.Potential.load(fname, aliases=aliases, mmap=mmap,
+                                                  lazy=lazy, crop=crop)
+            assert potential.crop == ((3, 15), (2, 9), (0, 5))
+            check_potential(potential, ref.data[:, 3:15, 2:, :-2],
+                            stride, cropped_origin)
+            assert (potential.x_index_to_axis(0) ==
+                        pytest.approx(ref.x_index_to_axis(3)))
+            assert (potential.y_axis_to_index(ref.y_index_to_axis(4)) ==
+                        pytest.approx(2))
+
+    # Crop in mm, expanded to include the boundary.
+    crop_mm = ((-1 + 3.5 * 0.005, -1 + 14.5 * 0.005), None, (0.2 + 2 * 0.003, None))
+    potential = potentials.Potential.load(fname, aliases=aliases, crop_mm=crop_mm)
+    assert potential.crop == ((3, 16), (0, 9), (2, 7))
+    check_potential(potential, ref.data[:, 3:16, :, 2:], stride,
+                    (-1 + 3 * 0.005, 0.1, 0.2 + 2 * 0.003))
+
+    raw = potentials.RawPotential.load(fname, crop=(None, (4, 5), None), mmap=True)
+    assert raw.data.shape == (data.shape[0], 20, 1, 7)
+    assert (np.asarray(raw.data) == data[:, :, 4:5, :]).all()
+
+    with pytest.raises(ValueError):
+        potentials.Potential.load(fname, crop=((5, 5), None, None))
+
+    h5name = tmp_path / "potential.h5"
+    ref.export_chunked(h5name, chunk_x=4)
+    potential = potentials.Potential.import_chunked(h5name, crop=crop)
+    check_potential(potential, ref.data[:, 3:15, 2:, :-2], stride, cropped_origin)
+    potential = potentials.Potential.import_chunked(h5name, crop_mm=crop_mm)
+    check_potential(potential, ref.data[:, 3:16, :, 2:], stride,
+                    (-1 + 3 * 0.005, 0.1, 0.2 + 2 * 0.003))
+    potential = potentials.Potential.import_chunked(h5name, x_range=(3, 15),
+                                                    crop=(None, (2, None), (None, -2)))
+    check_potential(potential, ref.data[:, 3:15, 2:, :-2], stride, cropped_origin)
+
+def test_float32(tmp_path):
+    data = random_data(seed=1357)
+    fname = tmp_path / "potential.bin"
+    write_potential(fname, '64', data, (0.005, 0.002, 0.003), (-1, 0, 0))
+    for aliases in (None, {"Q1": "Q0"}):
+        ref = potentials.Potential.load(fname, aliases=aliases)
+        for mmap in (False, True):
+            for lazy in (False, True):
+                potential = potentials.Potential.load(fname, aliases=aliases,
+                                                      mmap=mmap, lazy=lazy,
+                                                      dtype=np.float32)
+                assert potential.data.dtype == np.float32
+                assert potential.data[3].dtype == np.float32
+                assert (np.asarray(potential.data) == ref.data.astype(np.float32)).all()
+
+    h5name = tmp_path / "potential.h5"
+    ref.export_chunked(h5name)
+    potential = potentials.Potential.import_chunked(h5name, dtype=np.float32)
+    assert potential.data[2].dtype == np.float32
+    assert (potential.data[2] == ref.data[2].astype(np.float32)).all()
+
+def test_fit_store(tmp_path, monkeypatch):
+    data = random_data(seed=8642, shape=(30, 6, 6))
+    fname = tmp_path / "potential.bin"
+    write_potential(fname, '64', data, (0.005, 0.002, 0.003), (-1, 0, 0))
+    aliases = {"Q1": "Q0"}
+    store_name = tmp_path / "fits.h5"
+    fitter = fitting.PolyFitter((2, 2, 2), sizes=(9, 5, 5))
+    positions = [(3.2, 2.5, 1.7), (20, 3, 3), (12.5, 2, 4)]
+
+    potential = potentials.Potential.load(fname, aliases=aliases)
+    with potentials.FitStore(store_name, batch_size=4) as store:
+        fit_cache = potential.get_cache(fitter, store=store)
+        expected = {(ele, pos): fit_cache.get(ele, pos).coefficient
+                    for ele in ("Q0", "Q5", 3) for pos in positions}
+        # The fits are written in batches into one dataset per electrode
+        # indexed by the window start
+        group = fit_cache.get(3).store
+        assert group.fits.shape == (22, 2, 2, 27)
+        assert group.done.shape == (22, 2, 2)
+        assert sum(fit_cache.get(ele).store.done[()].sum()
+                   for ele in ("Q0", "Q5", 3)) == 8
+    with potentials.FitStore(store_name) as store:
+        group = store.group(potential.content_key(), fitter, 3,
+                            potential.data.shape[1:])
+        idxs = [fit_cache.get(3).fit_index(pos) for pos in positions]
+        assert group.done[()].sum() == 3
+        for (idx, pos) in zip(idxs, positions):
+            assert group.done[idx]
+            assert (group.fits[idx] == fit_cache.get(3).cache[idx].coefficient).all()
+
+    # The same potential in a different process should reuse the fits
+    def no_fit(*args, **kwargs):
+        raise AssertionError("Unexpected fit")
+    potential = potentials.Potential.load(fname, aliases=aliases, mmap=True)
+    with monkeypatch.context() as m:
+        m.setattr(fitting.PolyFitter, "fit", no_fit)
+        fit_cache = potential.get_cache(fitter, store=store_name)
+        for ((ele, pos), coefficient) in expected.items():
+            assert (fit_cache.get(ele, pos).coefficient == coefficient).all()
+
+        # Different fitter, crop or aliases shouldn't use the stored fits
+        potential2 = potentials.Potential.load(fname, aliases={"Q1": "Q3"})
+        fit_cache2 = potential2.get_cache(fitter, store=fit_cache.store)
+        with pytest.raises(AssertionError):
+            fit_cache2.get(3, positions[0])
+        potential2 = potentials.Potential.load(fname, aliases=aliases,
+                                               crop=((1, None), None, None))
+        fit_cache2 = potential2.get_cache(fitter, store=fit_cache.store)
+        with pytest.raises(AssertionError):
+            fit_cache2.get(3, positions[0])
+        fitter2 = fitting.PolyFitter((2, 2, 2), sizes=(9, 5, 5), center=(4, 2, 2.5))
+        fit_cache2 = potential.get_cache(fitter2, store=fit_cache.store)
+        with pytest.raises(AssertionError):
+            fit_cache2.get(3, positions[0])
+        # Neither should data stored in a different precision
+        potential2 = potentials.Potential.load(fname, aliases=aliases,
+                                               dtype=np.float32)
+        assert potential2.content_key() != potential.content_key()
+        fit_cache2 = potential2.get_cache(fitter, store=fit_cache.store)
+        with pytest.raises(AssertionError):
+            fit_cache2.get(3, positions[0])
+        fit_cache.close()
+        assert not fit_cache.store.file
+
+    # Potentials not loaded from a file are identified by the content
+    potential = potentials.Potential.load(fname, aliases=aliases)
+    del potential.source
+    potential2 = potentials.Potential.load(fname, aliases=aliases)
+    del potential2.source
+    assert potential.content_key() == potential2.content_key()
+    potential2.data[3, 0, 0, 0] += 1
+    assert potential.content_key() != potential2.content_key()
+
+
+def test_fit_store_exit(tmp_path):
+    data = random_data(seed=1357, shape=(30, 6, 6))
+    fname = tmp_path / "potential.bin"
+    write_potential(fname, '64', data, (0.005, 0.002, 0.003), (-1, 0, 0))
+    store_name = tmp_path / "fits.h5"
+    positions = [(3.2, 2.5, 1.7), (20, 3, 3), (12.5, 2, 4)]
+    # Fit through a store opened from the file name in a separate process
+    # that exits without closing or flushing the cache.
+    script = f"""
+from trap_dc import fitting, potentials
+potential = potentials.Potential.load({str(fname)!r})
+fitter = fitting.PolyFitter((2, 2, 2), sizes=(9, 5, 5))
+fit_cache = potential.get_cache(fitter, store={str(store_name)!r})
+for pos in {positions!r}:
+    fit_cache.get(3, pos)
+"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", script], cwd=root, check=True)
+
+    potential = potentials.Potential.load(fname)
+    fitter = fitting.PolyFitter((2, 2, 2), sizes=(9, 5, 5))
+    ref_cache = potential.get_cache(fitter)
+    with potentials.FitStore(store_name) as store:
+        group = store.group(potential.content_key(), fitter, 3,
+                            potential.data.shape[1:])
+        assert group.done[()].sum() == len(positions)
+        for pos in positions:
+            ref_cache.get(3, pos)
+            idx = ref_cache.get(3).fit_index(pos)
+            assert (group.load(idx) == ref_cache.get(3).cache[idx].coefficient).all()
+
+    # The cache closes the store it opened when it's garbage collected
+    fit_cache = potential.get_cache(fitter, store=store_name)
+    store = fit_cache.store
+    fit_cache.get(3, (8, 3, 3))
+    del fit_cache
+    assert not store.file
+
+def _shared_worker(handle, ele, pos):
+    potential = potentials.Potential.from_shared_memory(handle)
+    fit_cache = potential.get_cache(fitting.PolyFitter((2, 2, 2), sizes=(5, 5, 5)))
+    res = (potential.content_key(), fit_cache.get(ele, pos).coefficient.copy())
+    # Drop the views of the shared memory before closing it
+    del fit_cache
+    potential.close_shared_memory()
+    return res
+
+def test_shared_memory(tmp_path):
+    import concurrent.futures
+
+    data = random_data(seed=9753, shape=(12, 6, 6))
+    fname = tmp_path / "potential.bin"
+    write_potential(fname, '64', data, (0.005, 0.002, 0.003), (-1, 0, 0))
+    aliases = {"Q1": "Q0"}
+    ref = potentials.Potential.load(fname, aliases=aliases)
+    fitter = fitting.PolyFitter((2, 2, 2), sizes=(5, 5, 5))
+    ref_cache = ref.get_cache(fitter)
+    # Not using shared memory
+    ref.close_shared_memory()
+    assert ref.data is not None
+
+    potential = potentials.Potential.load(fname, aliases=aliases,
+                                          lazy=True, max_cached=1)
+    key = potential.content_key()
+    handle = potential.to_shared_memory()
+    assert potential.to_shared_memory() == handle
+    try:
+        assert (potential.data == np.asarray(ref.data)).all()
+        attached = potentials.Potential.from_shared_memory(handle)
+        assert attached.electrode_names == ref.electrode_names
+        assert attached.electrode_index == ref.electrode_index
+        check_potential(attached, np.asarray(ref.data), ref.stride, ref.origin)
+        assert not attached.data.flags.writeable
+        assert attached.content_key() == key
+        # No copy
+        potential.data[3, 1, 2, 3] = 100
+        assert attached.data[3, 1, 2, 3] == 100
+        potential.data[3, 1, 2, 3] = ref.data[3, 1, 2, 3]
+        attached.close_shared_memory()
+        assert attached.data is None
+        attached.close_shared_memory()
+
+        args = [("Q0", (5, 2.5, 2.5)), ("GND", (3.2, 1, 4)), (7, (10, 3, 3))]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=2) as pool:
+            results = list(pool.map(_shared_worker, [handle] * len(args),
+                                    *zip(*args)))
+        for ((ele, pos), (res_key, coefficient)) in zip(args, results):
+            assert res_key == key
+            assert coefficient == pytest.approx(ref_cache.get(ele, pos).coefficient)
+    finally:
+        potential.close_shared_memory(unlink=True)
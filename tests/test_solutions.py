@@ -1,10 +1,14 @@
 #!/usr/bin/python
 
-from trap_dc import solutions
+from trap_dc import fitting, optimizers, potentials, solutions
 
+import h5py
+import json
 import numpy as np
+import os
 import pytest
 
+@pytest.mark.filterwarnings("error")
 def test_find_flat():
     x, y = np.meshgrid(np.arange(10), np.arange(12), indexing='ij')
     for x0 in np.linspace(0, 8, 10):
@@ -27,6 +31,55 @@ def test_find_flat():
             assert xy0[0, zi] == pytest.approx(x0_z(zi), abs=2e-3)
             assert xy0[1, zi] == pytest.approx(y0_z(zi), abs=2e-3)
 
+@pytest.mark.filterwarnings("error")
+def test_find_flat_saddle(monkeypatch):
+    # Saddle with higher order terms (like the RF potential) so that the
+    # fitted gradient changes between the fit windows
+    # and has no exact root.
+    x, y, z = np.meshgrid(np.arange(60), np.arange(31), np.arange(31), indexing='ij')
+    y0 = 15 + 3 * np.sin(x[:, 0, 0] / 10)
+    z0 = 15 + 2 * np.cos(x[:, 0, 0] / 13)
+    y = (y - y0[:, None, None]) / 10
+    z = (z - z0[:, None, None]) / 10
+    data = (y**2 - z**2 + 0.3 * y**3 + 0.2 * y * z**2 + 0.05 * z**4
+            + 0.1 * y * z)
+    ncalls = [0]
+    gradient_hessian = fitting.PolyFitCache.gradient_hessian
+    def counted(*args, **kwargs):
+        ncalls[0] += 1
+        return gradient_hessian(*args, **kwargs)
+    monkeypatch.setattr(fitting.PolyFitCache, "gradient_hessian", counted)
+
+    yz0 = solutions.find_all_flat_points(data)
+    assert yz0[0] == pytest.approx(y0, abs=1e-4)
+    assert yz0[1] == pytest.approx(z0, abs=1e-3)
+    assert ncalls[0] <= 5 * len(data)
+
+    ncalls[0] = 0
+    data = data + np.random.default_rng(2345).normal(scale=1e-3, size=data.shape)
+    yz0 = solutions.find_all_flat_points(data)
+    assert yz0[0] == pytest.approx(y0, abs=0.3)
+    assert yz0[1] == pytest.approx(z0, abs=0.3)
+    assert ncalls[0] <= 7 * len(data)
+
+@pytest.mark.filterwarnings("error")
+def test_find_flat_parallel():
+    z, x, y = np.meshgrid(np.arange(200), np.arange(10), np.arange(12), indexing='ij')
+    def x0_z(z):
+        z = (z - 100) / 100
+        return 4.5 + z * 0.5
+    def y0_z(z):
+        z = (z - 100) / 100
+        return 5.5 + z**3 * 0.3
+    data = (x - x0_z(z))**2 - (y - y0_z(z))**2 * 0.1
+    xy0 = solutions.find_all_flat_points(data)
+    xy0_par = solutions.find_all_flat_points(data, workers=2)
+    assert xy0_par.shape == (2, 200)
+    assert xy0_par == pytest.approx(xy0, abs=1e-6)
+    xy0_par = solutions.find_all_flat_points(data, workers=3, chunk_size=30)
+    assert xy0_par.shape == (2, 200)
+    assert xy0_par == pytest.approx(xy0, abs=1e-6)
+
 def test_units():
     assert solutions.V_unit_uV == solutions.V_unit * 1e6
     assert solutions.l_unit_um == solutions.l_unit * 1e6
@@ -51,3 +104,390 @@ def test_center_tracker():
     assert center_hoa.get(1000.5) == pytest.approx(center_hoa.get(1000), abs=0.005)
     assert center_hoa.get(-1) == center_hoa.get(-1.5)
     assert center_hoa.get(10000) == center_hoa.get(20000)
+
+def make_potential(nx=301, ny=7, nz=7, dtype=None, seed=1234):
+    # Smooth random potentials for all the phoenix electrodes
+    # with a 2um grid spacing centered around the origin.
+    rng = np.random.default_rng(seed)
+    names = potentials._raw_electrode_names("phoenix")
+    potential = potentials.Potential()
+    potential.electrodes = len(names)
+    potential.nx, potential.ny, potential.nz = nx, ny, nz
+    potential.stride = (0.002, 0.002, 0.002)
+    potential.origin = (-(nx - 1) / 2 * 0.002, -(ny - 1) / 2 * 0.002,
+                        -(nz - 1) / 2 * 0.002)
+    potential.electrode_names = [[name] for name in names]
+    potential.electrode_index = {name: i for (i, name) in enumerate(names)}
+    x, y, z = np.meshgrid(np.arange(nx) - (nx - 1) / 2, np.arange(ny) - (ny - 1) / 2,
+                          np.arange(nz) - (nz - 1) / 2, indexing='ij')
+    data = np.empty((len(names), nx, ny, nz))
+    for i in range(len(names)):
+        x0, w, a, b, c = rng.uniform((-200, 20, 0.1, -0.02, -0.02),
+                                     (200, 100, 1, 0.02, 0.02))
+        data[i] = (a * np.exp(-((x - x0) / w)**2) * (1 + b * y + c * z)
+                       + b * c * y * z + (b * y)**2 - (c * z)**2)
+    potential.data = data if dtype is None else data.astype(dtype)
+    return potential
+
+def make_centers(tmp_path, nx, yz_index=None):
+    # RF center tracker for the potentials from `make_potential`,
+    # in the middle of the y-z grid by default.
+    if yz_index is None:
+        yz_index = np.full((2, nx), 3.0)
+    center_file = tmp_path / "rf_center.h5"
+    with h5py.File(center_file, 'w') as fh:
+        fh.create_dataset("yz_index", data=yz_index)
+    return solutions.CenterTracker(filename=center_file)
+
+def test_compensate_float32():
+    potential = make_potential()
+    potential32 = make_potential(dtype=np.float32)
+    cache = solutions.compensate_fitter1(potential)
+    cache32 = potential32.get_cache(cache.fitter, dtype=np.float32)
+    fitter = cache.fitter
+    eps = 2.0**-24
+    stride_um = np.array(potential.stride) * 1000
+    nterms = len(fitter.projection)
+    # Linear map from the (shifted) coefficients to the compensation terms
+    terms_mat = solutions.compensate_terms_matrix1(fitter.orders, stride_um)
+    for pos in [(150, 3, 3), (100.3, 2.8, 3.4), (210.6, 3.1, 2.9)]:
+        eles, coeff = solutions.get_compensate_coeff1(cache, pos)
+        eles32, coeff32 = solutions.get_compensate_coeff1(cache32, pos)
+        assert eles == eles32
+        fit_cache = cache.get(eles[0])
+        idx = fit_cache.fit_index(pos)
+        shift = np.array(pos) - idx - (fitter.sizes - 1) / 2
+        shift_mat = fitting._shift_coefficient(fitter.orders, np.eye(nterms), shift).T
+        slices = tuple(slice(i, i + s) for (i, s) in zip(idx, fitter.sizes))
+        for (i, e) in enumerate(eles):
+            raw = cache.get(e).cache[idx].coefficient
+            window = potential.data[e][slices]
+            bound = fitter.error_bound(np.abs(window).max(), eps) + np.abs(raw) * eps
+            bound = np.abs(terms_mat) @ (np.abs(shift_mat) @ bound)
+            assert (np.abs(coeff32[:, i] - coeff[:, i]) <= bound * (1 + 1e-8)).all()
+
+def ref_compensate_terms2(res, stride):
+    # Term by term computation of the compensation terms
+    scale_2 = solutions.l_unit_um**2 / solutions.V_unit
+    scale_3 = solutions.l_unit_um**3 / solutions.V_unit
+    scale_4 = solutions.l_unit_um**4 / solutions.V_unit
+    x2 = res[2, 0, 0] / stride[0]**2 * 2
+    y2 = res[0, 2, 0] / stride[1]**2 * 2
+    z2 = res[0, 0, 2] / stride[2]**2 * 2
+    return [res[1, 0, 0] / stride[0] * 1e6, res[0, 1, 0] / stride[1] * 1e6,
+            res[0, 0, 1] / stride[2] * 1e6,
+            res[1, 1, 0] / stride[0] / stride[1] * scale_2,
+            res[0, 1, 1] / stride[1] / stride[2] * scale_2,
+            res[1, 0, 1] / stride[2] / stride[0] * scale_2,
+            (z2 - y2) / 2 * scale_2, (2 * x2 - y2 - z2) / 3 * scale_2,
+            res[3, 0, 0] / stride[0]**3 * 6 * scale_3,
+            res[4, 0, 0] / stride[0]**4 * 24 * scale_4,
+            res[2, 0, 1] / stride[0]**2 / stride[2] * 2 * scale_3]
+
+def test_compensate_terms_many():
+    rng = np.random.default_rng(3579)
+    stride_um = np.array([2.0, 1.5, 3.0])
+    assert solutions.CompensateTerms1._fields == ("dx", "dy", "dz", "xy", "yz", "zx",
+                                                  "z2", "x2", "x3", "x4")
+    assert solutions.CompensateTerms2._fields == (*solutions.CompensateTerms1._fields,
+                                                  "x2z")
+    for orders in ((4, 2, 2), (8, 2, 2)):
+        nterms = fitting.math_prod(o + 1 for o in orders)
+        fits = rng.normal(size=(7, nterms))
+        for (terms, n) in ((1, 10), (2, 11)):
+            get_terms = getattr(solutions, f"get_compensate_terms{terms}")
+            get_terms_many = getattr(solutions, f"get_compensate_terms{terms}_many")
+            res = get_terms_many(fits, orders, stride_um)
+            assert res.shape == (n, 7)
+            for i in range(7):
+                fit = fitting.PolyFitResult(orders, fits[i])
+                expected = ref_compensate_terms2(fit, stride_um)[:n]
+                assert res[:, i] == pytest.approx(expected)
+                assert np.array(get_terms(fit, stride_um)) == pytest.approx(expected)
+            assert get_terms_many(fits[:0], orders, stride_um).shape == (n, 0)
+    with pytest.raises(ValueError):
+        solutions.compensate_terms_matrix1((3, 2, 2), stride_um)
+
+def test_term_spec():
+    stride_um = (2.0, 1.5, 3.0)
+    orders = (6, 2, 2)
+    spec = [solutions.TermSpec("x5", [((5, 0, 0), 1)]),
+            solutions.TermSpec("x2y", [((2, 1, 0), 0.5), ((0, 1, 2), -0.5)])]
+    mat = solutions.term_matrix(spec, orders, stride_um)
+    assert mat.shape == (2, 7 * 3 * 3)
+    assert mat.nnz == 3
+    # Compiled once
+    assert solutions.term_matrix(spec, np.array(orders), stride_um) is mat
+    fit = fitting.PolyFitResult(orders, np.random.default_rng(8).normal(size=63))
+    scale_3 = solutions.l_unit_um**3 / solutions.V_unit
+    scale_5 = solutions.l_unit_um**5 / solutions.V_unit
+    res = solutions.get_terms_many(spec, fit.coefficient[None, :], orders, stride_um)
+    assert res[:, 0] == pytest.approx(
+        [fit[5, 0, 0] * 120 / 2.0**5 * scale_5,
+         (fit[2, 1, 0] * 2 / 2.0**2 / 1.5 - fit[0, 1, 2] * 2 / 1.5 / 3.0**2) / 2
+         * scale_3])
+    with pytest.raises(ValueError):
+        solutions.term_matrix([solutions.TermSpec("bad", [((1, 0, 0), 1),
+                                                          ((2, 0, 0), 1)])],
+                              orders, stride_um)
+
+def make_fit_caches(seed):
+    # The cache under test, an independent one for the reference fits
+    # and the electrodes to fit.
+    potential = make_potential(nx=101, seed=seed)
+    fitter = fitting.PolyFitter((4, 2, 2), sizes=(21, 5, 5))
+    return (potential.get_cache(fitter), potential.get_cache(fitter),
+            ["Q0", "Q1", 5, "S3", "GND"])
+
+def check_fits(fits, ref_cache, eles, pos, **kwargs):
+    for (i, ele) in enumerate(eles):
+        expected = ref_cache.get(ele, pos, **kwargs)
+        assert fits[i] == pytest.approx(expected.coefficient)
+
+def test_fit_cache_get_all():
+    cache, ref_cache, eles = make_fit_caches(4321)
+    for pos in [(50, 3, 3), (3.2, 2.5, 4.1), (99, 6, 0), (47.5, 3, 3)]:
+        # Partially cached
+        cache.get(eles[1], pos)
+        fits = cache.get_all(eles, pos)
+        assert fits.shape == (len(eles), 45)
+        check_fits(fits, ref_cache, eles, pos)
+    fits = cache.get_all(eles, (50, 3, 3), fit_center=(30, 2, 2))
+    check_fits(fits, ref_cache, eles, (50, 3, 3), fit_center=(30, 2, 2))
+    assert cache.get_all([], (50, 3, 3)).shape == (0, 45)
+
+
+def test_fit_cache_warm():
+    cache, ref_cache, eles = make_fit_caches(2468)
+    positions = np.array([(x, 3, 3) for x in np.linspace(0, 100, 41)])
+    # Partially cached
+    cache.get(eles[2], positions[3])
+    nwindows = cache.warm(eles, positions, workers=4)
+    assert nwindows == len(np.unique(np.clip(np.round(positions[:, 0] - 10),
+                                             0, 80)))
+    for ele in eles:
+        assert len(cache.get(ele).cache) == nwindows
+    for pos in positions:
+        check_fits(cache.get_all(eles, pos), ref_cache, eles, pos)
+    for ele in eles:
+        assert len(cache.get(ele).cache) == nwindows
+    assert cache.warm([], positions) == 0
+
+def test_fit_cache_get_all_many():
+    cache, ref_cache, eles = make_fit_caches(1357)
+    pos = np.array([(50, 3, 3), (3.2, 2.5, 4.1), (99, 6, 0), (47.5, 3, 3)])
+    fits = cache.get_all_many(eles, pos)
+    assert fits.shape == (len(pos), len(eles), 45)
+    for (j, p) in enumerate(pos):
+        check_fits(fits[j], ref_cache, eles, p)
+    fits = cache.get_all_many(eles, pos, fit_center=(30, 2, 2))
+    for (j, p) in enumerate(pos):
+        check_fits(fits[j], ref_cache, eles, p, fit_center=(30, 2, 2))
+    assert cache.get_all_many([], pos).shape == (len(pos), 0, 45)
+
+def test_optimize_minmax_many():
+    rng = np.random.default_rng(97531)
+    A = rng.normal(size=(5, 12))
+    y = rng.normal(size=(5, 4))
+    X = optimizers.optimize_minmax(A, y)
+    assert A @ X == pytest.approx(y)
+    for i in range(4):
+        x = optimizers.optimize_minmax(A, y[:, i])
+        assert X[:, i] == pytest.approx(x)
+        assert np.abs(X[:, i]).max() <= np.abs(np.linalg.lstsq(A, y[:, i],
+                                                               rcond=None)[0]).max()
+
+def test_sweep_compensate(tmp_path):
+    nx = 401
+    potential = make_potential(nx=nx, seed=8642)
+    cache = solutions.compensate_fitter1(potential, sizes=(65, 5, 5))
+    ref_cache = solutions.compensate_fitter1(potential, sizes=(65, 5, 5))
+    x = np.arange(nx)
+    centers = make_centers(tmp_path, nx, np.array([3 + 0.2 * np.sin(x / 30),
+                                                   3 + 0.1 * np.cos(x / 20)]))
+    xidxs = np.array([-3, 0, 10.4, 200.5, 399, 402])
+    ys, zs = centers.get_many(xidxs)
+    for (xidx, y, z) in zip(xidxs, ys, zs):
+        assert (y, z) == pytest.approx(centers.get(xidx))
+
+    xs = np.array([-150, -149.5, -120, 0, 3, 133.3])
+    for terms in (1, 2):
+        solve = getattr(solutions, f"solve_compensate{terms}")
+        sweep = solutions.sweep_compensate(cache, xs, centers, terms=terms,
+                                           electrode_min_num=12,
+                                           electrode_min_dist=210)
+        nterms = 9 + terms
+        assert (sweep.xs == xs).all()
+        assert sweep.positions.shape == (len(xs), 3)
+        assert sweep.electrodes.shape == (len(xs), potential.electrodes)
+        assert len(sweep.terms) == nterms
+        assert sweep.voltages.shape == (len(xs), nterms, potential.electrodes)
+        for (i, x) in enumerate(xs):
+            xidx = potential.x_axis_to_index(x / 1000)
+            pos = (xidx, *centers.get(xidx))
+            assert sweep.positions[i] == pytest.approx(pos)
+            eles, voltages = solve(ref_cache, pos, electrode_min_num=12,
+                                   electrode_min_dist=210)
+            assert np.nonzero(sweep.electrodes[i])[0].tolist() == eles
+            assert voltages._fields == sweep.terms
+            for (j, v) in enumerate(voltages):
+                assert sweep.voltages[i, j, eles] == pytest.approx(v, rel=1e-6, abs=1e-6)
+            assert (sweep.voltages[i][:, ~sweep.electrodes[i]] == 0).all()
+
+def test_generate_compensate(tmp_path):
+    nx = 401
+    potential = make_potential(nx=nx, seed=7531)
+    fitter = fitting.get_fitter((4, 2, 2), sizes=(65, 5, 5))
+    ref_cache = potential.get_cache(fitter)
+    centers = make_centers(tmp_path, nx)
+    xs = list(range(-120, 121, 20))
+    kwargs = dict(electrode_min_num=12, electrode_min_dist=210)
+
+    def check(prefix_dir):
+        for x in xs:
+            xidx = potential.x_axis_to_index(x / 1000)
+            eles, voltages = solutions.solve_compensate1(ref_cache, (xidx, 3, 3),
+                                                         **kwargs)
+            with h5py.File(prefix_dir / f"{x}.h5", 'r') as fh:
+                assert json.loads(fh["electrode_names"][()]) == potential.electrode_names
+                assert list(fh["electrodes"]) == eles
+                for name in voltages._fields:
+                    assert (fh["solutions"][name][()] ==
+                            pytest.approx(getattr(voltages, name), rel=1e-6, abs=1e-6))
+
+    progress = []
+    prefix_dir = tmp_path / "serial"
+    assert solutions.generate_compensate(
+        potential, fitter, centers, xs, str(prefix_dir), workers=1, chunk_size=4,
+        progress=lambda *args: progress.append(args), **kwargs) == len(xs)
+    assert [p[:2] for p in progress] == [(4, 13), (8, 13), (12, 13), (13, 13)]
+    check(prefix_dir)
+
+    # The fits are persisted in the store passed in `cache_kwargs`
+    prefix_dir = tmp_path / "stored"
+    store_name = tmp_path / "fits.h5"
+    with pytest.raises(ValueError):
+        solutions.generate_compensate(
+            potential, fitter, centers, xs, str(prefix_dir), workers=2,
+            progress=None, cache_kwargs=dict(store=store_name), **kwargs)
+    assert solutions.generate_compensate(
+        potential, fitter, centers, xs, str(prefix_dir), workers=1,
+        progress=None, cache_kwargs=dict(store=store_name), **kwargs) == len(xs)
+    check(prefix_dir)
+    with h5py.File(prefix_dir / "0.h5", 'r') as fh:
+        ele = int(fh["electrodes"][0])
+    with potentials.FitStore(store_name) as store:
+        group = store.group(potential.content_key(), fitter, ele,
+                            potential.data.shape[1:])
+        assert group.done[()].any()
+
+    prefix_dir = tmp_path / "parallel"
+    try:
+        assert solutions.generate_compensate(
+            potential, fitter, centers, xs, str(prefix_dir), workers=2,
+            progress=None, **kwargs) == len(xs)
+        check(prefix_dir)
+        # Resume
+        (prefix_dir / "-40.h5").unlink()
+        (prefix_dir / "100.h5").unlink()
+        assert solutions.generate_compensate(
+            potential.to_shared_memory(), fitter, centers, xs, str(prefix_dir),
+            workers=2, progress=None, cache_kwargs=dict(max_entries=500),
+            **kwargs) == 2
+        check(prefix_dir)
+        assert sorted(os.listdir(prefix_dir)) == sorted(f"{x}.h5" for x in xs)
+    finally:
+        potential.close_shared_memory(unlink=True)
+
+    assert solutions.compensate_filename("a", 3.0) == os.path.join("a", "3.h5")
+    assert (solutions.compensate_filename("a", 100.1234) !=
+            solutions.compensate_filename("a", 100.1226))
+    assert solutions.compensate_filename("a", -0.125) == os.path.join("a", "-0.125.h5")
+
+def test_solution_store(tmp_path):
+    import shutil
+
+    nx = 401
+    potential = make_potential(nx=nx, seed=9753)
+    fitter = fitting.get_fitter((4, 2, 2), sizes=(65, 5, 5))
+    centers = make_centers(tmp_path, nx)
+    xs = list(range(-100, 101, 25))
+    kwargs = dict(electrode_min_num=12, electrode_min_dist=210, workers=1,
+                  chunk_size=3, progress=None)
+    prefix_dir = tmp_path / "solutions"
+    solutions.generate_compensate(potential, fitter, centers, xs, str(prefix_dir),
+                                  **kwargs)
+
+    def check(store):
+        assert store.electrode_names == potential.electrode_names
+        assert store.terms == solutions.CompensateTerms1._fields
+        assert (store.xs == xs).all()
+        assert store.done.all()
+        sweep = store.read()
+        assert sweep.voltages.shape == (len(xs), 10, potential.electrodes)
+        for (i, x) in enumerate(xs):
+            assert store.has(x)
+            eles, voltages = store.get(x)
+            assert (np.nonzero(sweep.electrodes[i])[0] == eles).all()
+            with h5py.File(prefix_dir / f"{x}.h5", 'r') as fh:
+                assert (fh["electrodes"][()] == eles).all()
+                for (j, name) in enumerate(store.terms):
+                    assert (fh["solutions"][name][()] == voltages[name]).all()
+                    assert (sweep.voltages[i, j, eles] == voltages[name]).all()
+        part = store.read(slice(2, 5))
+        assert (part.xs == xs[2:5]).all()
+        assert (part.voltages == sweep.voltages[2:5]).all()
+
+    solutions.convert_compensate_dir(prefix_dir, tmp_path / "converted.h5")
+    with solutions.SolutionStore(tmp_path / "converted.h5") as store:
+        check(store)
+        assert np.isnan(store.read().positions).all()
+
+    store_file = tmp_path / "store.h5"
+    with solutions.SolutionStore.open_or_create(
+            store_file, xs, potential.electrode_names,
+            solutions.CompensateTerms1._fields) as store:
+        assert not store.has(xs[0])
+        assert solutions.generate_compensate(potential, fitter, centers, xs[:4],
+                                             store, **kwargs) == 4
+    with solutions.SolutionStore.open_or_create(
+            store_file, xs, potential.electrode_names,
+            solutions.CompensateTerms1._fields) as store:
+        assert store.done.tolist() == [True] * 4 + [False] * (len(xs) - 4)
+        assert not store.read(slice(4, None)).electrodes.any()
+        # Resume
+        assert solutions.generate_compensate(potential, fitter, centers, xs,
+                                             store, **kwargs) == len(xs) - 4
+        check(store)
+        assert store.read().positions[:, 1:] == pytest.approx(3)
+    # Positions not in the store are rejected before anything is computed
+    with solutions.SolutionStore.create(tmp_path / "store2.h5", xs[:2],
+                                        potential.electrode_names,
+                                        solutions.CompensateTerms1._fields) as store:
+        with pytest.raises(ValueError):
+            solutions.generate_compensate(potential, fitter, centers, xs[:3],
+                                          store, **kwargs)
+        assert not store.done.any()
+    with pytest.raises(ValueError):
+        solutions.SolutionStore.open_or_create(store_file, xs[1:],
+                                               potential.electrode_names,
+                                               solutions.CompensateTerms1._fields)
+
+    # Convert some of the existing solutions
+    data_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                            "data", "compensate_red_20221222")
+    prefix_dir = tmp_path / "compensate_red_20221222"
+    prefix_dir.mkdir()
+    for x in (-3, 0, 120, 7):
+        shutil.copy(os.path.join(data_dir, f"{x}.h5"), prefix_dir)
+    solutions.convert_compensate_dir(prefix_dir, tmp_path / "red.h5")
+    with solutions.SolutionStore(tmp_path / "red.h5") as store:
+        assert store.xs.tolist() == [-3, 0, 7, 120]
+        assert store.terms == solutions.CompensateTerms1._fields
+        for x in store.xs:
+            eles, voltages = store.get(x)
+            with h5py.File(prefix_dir / f"{int(x)}.h5", 'r') as fh:
+                assert json.loads(fh["electrode_names"][()]) == store.electrode_names
+                assert (fh["electrodes"][()] == eles).all()
+                for name in store.terms:
+                    assert (fh["solutions"][name][()] == voltages[name]).all()
@@ -16,7 +16,10 @@
 # License along with this library. If not,
 # see <http://www.gnu.org/licenses/>.
 
+import collections
+import functools
 import math
+import threading
 import numpy as np
 from scipy.special import binom
 
@@ -105,9 +108,19 @@ class CartesianIndices:
             return _linear_to_cartesian(self.__sizes, idx[0])
         return idx
 
+def _kron_all(arys):
+    res = arys[0]
+    for a in arys[1:]:
+        res = np.kron(res, a)
+    return res
+
 class PolyFitter:
     # center is the origin of the polynomial in index (0-based)
-    def __init__(self, orders, sizes=None, center=None):
+    # With `separable`, the fit is done by applying the projection for each axis
+    # in sequence rather than using the full (npoints x nterms) projection.
+    # The two are mathematically equivalent since both the grid
+    # and the polynomial basis are tensor products.
+    def __init__(self, orders, sizes=None, center=None, separable=True):
         orders = np.array(orders, dtype='q')
         self.orders = orders
         if sizes is None:
@@ -121,37 +134,229 @@ class PolyFitter:
             center = np.array(center, dtype='d')
 
         assert (sizes > orders).all()
-        nterms = math_prod(orders + 1)
-        npoints = math_prod(sizes)
-
-        self.coefficient = np.empty((npoints, nterms))
-        pos_lidxs = LinearIndices(sizes)
-        pos_cidxs = CartesianIndices(sizes)
-        ord_lidxs = LinearIndices(orders + 1)
-        ord_cidxs = CartesianIndices(orders + 1)
-        self.scales = np.empty(nterms)
+        self.center = center
+
+        # Both the grid and the polynomial terms are tensor products of the
+        # ones along each axis, so the coefficient matrix (in row major order
+        # for both the positions and the orders) is the kronecker product of
+        # the (scaled) Vandermonde matrices for each axis.
         scale_max = np.maximum((sizes - 1) / 2, 1.0)
-        for iorder in ord_lidxs:
-            order = np.array(ord_cidxs[iorder])
-            self.scales[iorder] = 1 / math_prod(scale_max**order)
-
-        # Index for position
-        for ipos in pos_lidxs:
-            # Position of the point, with the origin in the middle of the grid.
-            pos = np.array(pos_cidxs[ipos]) - center
-            # Index for the polynomial order
-            for iorder in ord_lidxs:
-                order = np.array(ord_cidxs[iorder])
-                self.coefficient[ipos, iorder] = (math_prod(pos**order) *
-                                                  self.scales[iorder])
+        self.axis_coefficients = []
+        self.axis_scales = []
+        for (order, size, c, sm) in zip(orders, sizes, center, scale_max):
+            powers = np.arange(order + 1)
+            scales = 1 / sm**powers
+            pos = np.arange(size) - c
+            self.axis_scales.append(scales)
+            self.axis_coefficients.append(pos[:, None]**powers * scales)
+        self.scales = _kron_all(self.axis_scales)
+        self.coefficient = _kron_all(self.axis_coefficients)
+
+        # The coefficient matrix never changes after construction
+        # so we can compute the least square projection once
+        # and turn each fit into a single matrix multiplication.
+        # The scales are folded into the projection matrix.
+        # The pseudo-inverse of a kronecker product is the kronecker product
+        # of the pseudo-inverses so we can also do this for each axis.
+        self.separable = separable
+        self.axis_projections = [np.linalg.pinv(c) * s[:, None] for (c, s)
+                                 in zip(self.axis_coefficients, self.axis_scales)]
+        if separable:
+            self.projection = _kron_all(self.axis_projections)
+        else:
+            self.projection = (np.linalg.pinv(self.coefficient) *
+                               self.scales[:, None])
+
+    def __fit_separable(self, data):
+        # Contract the first spatial axis with the projection for that axis
+        # and append the order axis at the end.
+        # After going through all the axes, the order axes are
+        # in the right (row major) order.
+        nbatch = data.ndim - len(self.sizes)
+        for proj in self.axis_projections:
+            data = np.tensordot(data, proj, axes=([nbatch], [1]))
+        return np.reshape(data, (*data.shape[:nbatch], -1))
 
     def fit(self, data):
-        res = np.linalg.lstsq(self.coefficient,
-                              np.reshape(data, -1), rcond=None)[0] * self.scales
+        if self.separable:
+            res = self.__fit_separable(np.reshape(data, tuple(self.sizes)))
+        else:
+            res = self.projection @ np.reshape(data, -1)
         return PolyFitResult(self.orders, res)
 
-def _shifted_term(max_order, term_order, shift):
-    return shift**(max_order - term_order) * binom(max_order, term_order)
+    def fit_many(self, data):
+        """
+        Fit a stack of windows with a single matrix multiplication
+        (or a single contraction per axis for separable fitters).
+
+        The last `ndim` dimensions of `data` should match `sizes` and all
+        the leading ones are treated as batch dimensions.
+        Return the coefficient array with the shape `(batch..., nterms)`.
+        """
+        data = np.asarray(data)
+        ndim = len(self.sizes)
+        assert tuple(data.shape[data.ndim - ndim:]) == tuple(self.sizes)
+        batch = data.shape[:data.ndim - ndim]
+        if self.separable:
+            return self.__fit_separable(data)
+        res = np.reshape(data, (-1, self.projection.shape[1])) @ self.projection.T
+        return np.reshape(res, (*batch, self.projection.shape[0]))
+
+    def error_bound(self, data_max, rel_error):
+        """
+        Upper bound of the error of each fitted coefficient if each data point
+        has an error of at most `data_max * rel_error`,
+        e.g. from rounding data with a maximum magnitude of `data_max`
+        to a lower precision type with the relative precision `rel_error`.
+        """
+        return np.abs(self.projection).sum(axis=1) * (data_max * rel_error)
+
+    def fit_field(self, data, axes=None, starts=None):
+        """
+        Compute the fit for every valid window start along `axes`
+        (all axes by default) in one pass.
+
+        This is the N-D version of a Savitzky-Golay filter, i.e. the fits are
+        computed as separable correlations of the data with the projection
+        for each axis.
+        The window start along the remaining axes is given by `starts`
+        (indexed by axis, entries for `axes` are ignored).
+        Return the coefficient array with the shape `(n_windows..., nterms)`
+        with one window dimension for each of the axes in `axes`.
+        """
+        ndim = len(self.sizes)
+        assert data.ndim == ndim
+        axes = range(ndim) if axes is None else sorted(axes)
+        axes = tuple(axes)
+        if len(axes) != ndim:
+            assert starts is not None
+        data = data[tuple(slice(None) if i in axes else
+                          slice(starts[i], starts[i] + self.sizes[i])
+                          for i in range(ndim))]
+        # The array always starts with the window axes for the axes we've
+        # processed, followed by the spatial axes we haven't processed and
+        # the order axes for all the processed ones.
+        nwin = 0
+        for (i, (size, proj)) in enumerate(zip(self.sizes, self.axis_projections)):
+            data = np.moveaxis(data, nwin, -1)
+            if i in axes:
+                data = np.lib.stride_tricks.sliding_window_view(data, size,
+                                                                axis=-1)
+            data = data @ proj.T
+            if i in axes:
+                data = np.moveaxis(data, -2, nwin)
+                nwin += 1
+        return np.reshape(data, (*data.shape[:nwin], -1))
+
+_fitter_registry = {}
+_fitter_registry_lock = threading.Lock()
+
+def get_fitter(orders, sizes=None, center=None, separable=True):
+    """
+    Return a `PolyFitter` with the given parameters.
+
+    The fitters are memoized so that identical fitters are only constructed once
+    per process. The returned fitter is shared and should not be mutated.
+    """
+    orders = tuple(int(o) for o in np.atleast_1d(orders))
+    if sizes is None:
+        sizes = tuple(o + 1 for o in orders)
+    else:
+        sizes = tuple(int(s) for s in np.atleast_1d(sizes))
+    if center is not None:
+        center = tuple(float(c) for c in np.atleast_1d(center))
+    key = (orders, sizes, center, bool(separable))
+    with _fitter_registry_lock:
+        fitter = _fitter_registry.get(key)
+        if fitter is None:
+            fitter = PolyFitter(orders, sizes=sizes, center=center,
+                                separable=separable)
+            _fitter_registry[key] = fitter
+        return fitter
+
+@functools.lru_cache(maxsize=None)
+def _pascal_matrix(order):
+    # Upper triangular matrix with `binom(k, j)` at `[j, k]` and the power
+    # of the shift for the corresponding element.
+    powers = np.arange(order + 1)
+    exps = powers[None, :] - powers[:, None]
+    pascal = binom(powers[None, :], powers[:, None])
+    pascal[exps < 0] = 0
+    exps[exps < 0] = 0
+    return pascal, exps
+
+def _shift_matrix(order, shift):
+    """
+    The matrix that maps the polynomial coefficients along one axis
+    to the ones with the origin shifted by `shift`, i.e.
+    the coefficient of `x^j` after the shift is
+    `sum(binom(k, j) * shift^(k - j) * c[k] for k >= j)`.
+
+    `shift` can be an array in which case the matrices are stacked in the
+    leading dimensions.
+    """
+    pascal, exps = _pascal_matrix(int(order))
+    shift = np.asarray(shift, dtype='d')
+    return pascal * shift[..., None, None]**exps
+
+def _shift_coefficient(orders, coefficient, shift):
+    """
+    Shift the (stack of) coefficient(s) with the shape `(batch..., nterms)`
+    by `shift` with the shape `(..., ndim)`.
+    The batch dimensions of `coefficient` and `shift` are broadcasted.
+    """
+    shift = np.asarray(shift, dtype='d')
+    sizes = tuple(int(o) + 1 for o in orders)
+    batch = np.broadcast_shapes(coefficient.shape[:-1], shift.shape[:-1])
+    nbatch = len(batch)
+    c = np.broadcast_to(coefficient, (*batch, coefficient.shape[-1]))
+    c = np.reshape(c, (*batch, *sizes))
+    for (i, size) in enumerate(sizes):
+        m = _shift_matrix(size - 1, shift[..., i])
+        c = np.moveaxis(c, nbatch + i, -1)
+        # Merge all the other order axes so that the batch dimensions of
+        # the shift matrices are broadcasted to the ones of the coefficient.
+        shape = c.shape
+        c = np.reshape(c, (*batch, -1, size)) @ np.swapaxes(m, -1, -2)
+        c = np.moveaxis(np.reshape(c, shape), -1, nbatch + i)
+    return np.reshape(c, (*batch, -1))
+
+def _shifted_rows(orders, shift, order):
+    # The row of the shift matrix for each axis corresponding to `order`.
+    return [_shift_matrix(o, s)[..., t, :] for (o, s, t)
+            in zip(orders, np.moveaxis(np.asarray(shift, dtype='d'), -1, 0),
+                   order)]
+
+def _contract_rows(orders, coefficient, rows):
+    # Contract each order axis of the coefficient
+    # with the corresponding row vector.
+    sizes = tuple(int(o) + 1 for o in orders)
+    c = np.reshape(coefficient, (*coefficient.shape[:-1], *sizes))
+    for (i, row) in reversed(tuple(enumerate(rows))):
+        row = np.reshape(row, (*row.shape[:-1], *((1,) * i), row.shape[-1]))
+        c = (c * row).sum(axis=-1)
+    return c
+
+def _vandermonde(order, x, nderiv=0):
+    # Matrix with `d^nderiv(x^k)/dx^nderiv` at `[..., k]`
+    powers = np.arange(order + 1)
+    exps = powers - nderiv
+    factor = np.ones(order + 1)
+    for i in range(nderiv):
+        factor = factor * (powers - i)
+    factor[exps < 0] = 0
+    exps[exps < 0] = 0
+    return factor * np.asarray(x, dtype='d')[..., None]**exps
+
+def _contract_vandermonde(orders, coefficient, mats):
+    # Compute `sum(c[k...] * prod(mats[d][p, k[d]]))` for each point `p`
+    # by contracting one axis at a time.
+    c = np.reshape(coefficient, (int(orders[0]) + 1, -1))
+    res = mats[0] @ c
+    for (order, mat) in zip(orders[1:], mats[1:]):
+        res = np.reshape(res, (res.shape[0], int(order) + 1, -1))
+        res = np.einsum('pj,pjr->pr', mat, res)
+    return np.reshape(res, res.shape[0])
 
 class PolyFitResult:
     def __init__(self, orders, coefficient):
@@ -180,15 +385,42 @@ class PolyFitResult:
 
     def __call__(self, *pos):
         assert len(pos) == len(self.orders)
-        sizes = self.orders + 1
-        lindices = LinearIndices(sizes)
-        cindices = CartesianIndices(sizes)
-        v = 0.0
-        pos = np.array(pos)
-        for iorder in lindices:
-            order = cindices[iorder]
-            v += self.coefficient[iorder] * math_prod(pos**order)
-        return v
+        return self.evaluate(np.array(pos, dtype='d')[None, :])[0]
+
+    def evaluate(self, points, gradient=False, hessian=False):
+        """
+        Evaluate the polynomial on an `(npoints, ndim)` array of positions.
+
+        Return the `(npoints,)` values. If `gradient` or `hessian` is `True`,
+        a tuple is returned that also includes the `(npoints, ndim)` gradient
+        and/or the `(npoints, ndim, ndim)` hessian.
+        """
+        ndim = len(self.orders)
+        points = np.asarray(points, dtype='d')
+        points = np.reshape(points, (-1, ndim))
+        maxderiv = 2 if hessian else (1 if gradient else 0)
+        mats = [[_vandermonde(o, points[:, i], n) for n in range(maxderiv + 1)]
+                for (i, o) in enumerate(self.orders)]
+        def evaluate_deriv(nderivs):
+            return _contract_vandermonde(self.orders, self.coefficient,
+                                         [m[n] for (m, n) in zip(mats, nderivs)])
+        values = evaluate_deriv((0,) * ndim)
+        if not gradient and not hessian:
+            return values
+        res = (values,)
+        if gradient:
+            grad = np.empty((points.shape[0], ndim))
+            for i in range(ndim):
+                grad[:, i] = evaluate_deriv(tuple(int(i == j) for j in range(ndim)))
+            res = (*res, grad)
+        if hessian:
+            hess = np.empty((points.shape[0], ndim, ndim))
+            for i in range(ndim):
+                for j in range(i, ndim):
+                    nderivs = tuple(int(i == k) + int(j == k) for k in range(ndim))
+                    hess[:, i, j] = hess[:, j, i] = evaluate_deriv(nderivs)
+            res = (*res, hess)
+        return res
 
     def __getitem__(self, order):
         order = to_tuple(order)
@@ -199,30 +431,15 @@ class PolyFitResult:
         self.coefficient[_cartesian_to_linear(self.orders + 1, order)] = v
 
     def _shifted_coefficient(self, shift, order):
-        v = 0.0
-        sizes = self.orders + 1
-        lindices = LinearIndices(sizes)
-        cindices = CartesianIndices(sizes)
-        for lidx in lindices:
-            term_order = np.array(cindices[lidx])
-            if not (term_order >= order).all():
-                continue
-            v += math_prod(_shifted_term(t, o, s) for (t, o, s)
-                           in zip(term_order, order, shift)) * self.coefficient[lidx]
-        return v
+        return _contract_rows(self.orders, self.coefficient,
+                              _shifted_rows(self.orders, shift, order))
 
     # shift the solution to get the polynomial representing the same function
     # but with the origin shifted to `shift`.
     # `x` with a shift of `1` becomes `x + 1`.
     def shift(self, shift):
-        coefficient = np.empty(self.coefficient.shape)
-        sizes = self.orders + 1
-        lindices = LinearIndices(sizes)
-        cindices = CartesianIndices(sizes)
-        for lidx in lindices:
-            order = cindices[lidx]
-            coefficient[lidx] = self._shifted_coefficient(shift, order)
-        return PolyFitResult(self.orders, coefficient)
+        return PolyFitResult(self.orders,
+                             _shift_coefficient(self.orders, self.coefficient, shift))
 
     def gradient(self, dim, pos):
         order = tuple(int(i == dim) for i in range(len(self.orders)))
@@ -240,31 +457,248 @@ def _best_fit_idx(ntotal, kernel_size, pos):
         return ntotal - kernel_size
     return idx
 
+def _best_fit_idxs(ntotal, kernel_size, pos):
+    # Vectorized version of `_best_fit_idx`
+    idx = np.round(np.asarray(pos) - (kernel_size - 1) / 2)
+    return np.clip(idx, 0, ntotal - kernel_size).astype(np.int64)
+
+class CacheBudget:
+    """
+    Least-recently-used accounting for the entries in one or more `PolyFitCache`.
+
+    When either the number of entries exceeds `max_entries` or the total
+    size of the cached coefficients exceeds `max_bytes`, the least recently used
+    entries are evicted from the cache they belong to.
+    The same budget can be shared by multiple caches (e.g. the ones for
+    all the electrodes in a `FitCache`) in which case the limits apply
+    to all of them together.
+    The budget may be used from multiple threads.
+    """
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __over_budget(self):
+        if self.max_entries is not None and len(self.__entries) > self.max_entries:
+            return True
+        if self.max_bytes is not None and self.nbytes > self.max_bytes:
+            return True
+        return False
+
+    def touch(self, cache, key):
+        with self.__lock:
+            # The entry could have just been evicted by another thread.
+            if (id(cache), key) in self.__entries:
+                self.__entries.move_to_end((id(cache), key))
+
+    def add(self, cache, key, nbytes):
+        with self.__lock:
+            self.__remove(cache, key)
+            self.__entries[(id(cache), key)] = (cache, nbytes)
+            self.nbytes += nbytes
+            # Always keep the newest entry
+            while len(self.__entries) > 1 and self.__over_budget():
+                ((_, old_key), (old_cache, old_nbytes)) = self.__entries.popitem(last=False)
+                self.nbytes -= old_nbytes
+                # This only pops the entry from the cache dict without taking
+                # any lock so the caches can call into the budget
+                # while holding their own lock.
+                old_cache._evict(old_key)
+
+    def __remove(self, cache, key):
+        entry = self.__entries.pop((id(cache), key), None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+    def remove(self, cache, key):
+        with self.__lock:
+            self.__remove(cache, key)
+
 class PolyFitCache:
-    def __init__(self, fitter, data):
+    # If `max_entries` or `max_bytes` are specified, the cached fits are
+    # evicted in least-recently-used order to stay within the limits.
+    # Alternatively, a `CacheBudget` can be passed in as `budget`,
+    # which can be shared with other caches.
+    # The fitted coefficients are stored as `dtype` (e.g. `np.float32` to halve
+    # the memory usage) if specified. The fits and the shifts are always
+    # computed in double precision.
+    # `store` is an optional persistent storage for the fits with `load(idx)`
+    # (returning `None` if the fit for the window isn't available)
+    # and `save(idx, coefficient)` methods.
+    # The cache can be shared by multiple threads. Each window is only fitted
+    # once, threads requesting a window that is being fitted by another
+    # thread wait for that fit to finish.
+    def __init__(self, fitter, data, max_entries=None, max_bytes=None, budget=None,
+                 dtype=None, store=None):
         self.fitter = fitter
         self.data = data
         self.cache = {}
+        self.__lock = threading.Lock()
+        self.__pending = {}
+        self.dtype = dtype
+        self.store = store
+        if budget is None and (max_entries is not None or max_bytes is not None):
+            budget = CacheBudget(max_entries=max_entries, max_bytes=max_bytes)
+        self.budget = budget
+        # `(field, axes, starts)` of the precomputed field, published together
+        # so that concurrent lookups never see a partially updated field.
+        self.__field = None
+
+    @property
+    def field(self):
+        field = self.__field
+        return None if field is None else field[0]
+
+    @property
+    def field_axes(self):
+        field = self.__field
+        return None if field is None else field[1]
+
+    @property
+    def field_starts(self):
+        field = self.__field
+        return None if field is None else field[2]
+
+    def fill_field(self, axes=None, starts=None):
+        """
+        Precompute the fits for all the window starts along `axes`.
+
+        For the other axes, the window start is fixed to the one in `starts`
+        (which are the indices returned by `fit_index`).
+        Fits for any windows covered by the field are looked up
+        directly from the field afterwards.
+        """
+        ndim = len(self.fitter.sizes)
+        axes = tuple(range(ndim) if axes is None else sorted(axes))
+        field = self.fitter.fit_field(self.data, axes, starts)
+        if self.dtype is not None:
+            field = field.astype(self.dtype)
+        starts = (None if starts is None else
+                  tuple(None if i in axes else int(starts[i]) for i in range(ndim)))
+        with self.__lock:
+            self.__field = (field, axes, starts)
+
+    def __get_field(self, field, idx):
+        (field, axes, starts) = field
+        if starts is not None:
+            for i in range(len(idx)):
+                if i not in axes and idx[i] != starts[i]:
+                    return
+        return PolyFitResult(self.fitter.orders, field[tuple(idx[i] for i in axes)])
+
+    def fit_index(self, fit_center):
+        """
+        The start index of the window used to fit around `fit_center`.
+        """
+        kernel_sizes = self.fitter.sizes
+        data_sizes = self.data.shape
+        return tuple(_best_fit_idx(n, k, p) for (n, k, p)
+                     in zip(data_sizes, kernel_sizes, fit_center))
 
-    def __get_internal(self, idx):
-        # idx is the start index
-        if idx in self.cache:
-            return self.cache[idx]
-        data = self.data[tuple(slice(i, i + s) for (i, s)
-                         in zip(idx, self.fitter.sizes))]
-        res = self.fitter.fit(data)
+    def _lookup(self, idx):
+        # Find the fit for the window starting at `idx` without fitting.
+        # The entry may be evicted concurrently so only look it up once.
+        res = self.cache.get(idx)
+        if res is not None:
+            if self.budget is not None:
+                self.budget.touch(self, idx)
+            return res
+        field = self.__field
+        if field is not None:
+            res = self.__get_field(field, idx)
+            if res is not None:
+                return res
+        coefficient = None if self.store is None else self.store.load(idx)
+        if coefficient is not None:
+            return self.__insert(idx, coefficient)
+
+    def __insert(self, idx, coefficient):
+        if self.dtype is not None:
+            coefficient = coefficient.astype(self.dtype)
+        res = PolyFitResult(self.fitter.orders, coefficient)
         self.cache[idx] = res
+        if self.budget is not None:
+            self.budget.add(self, idx, res.coefficient.nbytes)
+        return res
+
+    def _insert_fit(self, idx, coefficient):
+        # Add a new fit result for the window starting at `idx`
+        if self.store is not None:
+            self.store.save(idx, coefficient)
+        return self.__insert(idx, coefficient)
+
+    def _acquire(self, idx, wait=True):
+        # Return `(fit, claimed)`.
+        # If the fit for the window starting at `idx` is available, `fit` is
+        # the result. Otherwise, if `claimed` is `True`, the caller is now
+        # responsible for fitting the window and must call `_release` afterwards.
+        # If the window is being fitted by another thread, wait for it
+        # if `wait` is `True`, or return `(None, False)` otherwise.
+        while True:
+            with self.__lock:
+                res = self._lookup(idx)
+                if res is not None:
+                    return res, False
+                event = self.__pending.get(idx)
+                if event is None:
+                    self.__pending[idx] = threading.Event()
+                    return None, True
+            if not wait:
+                return None, False
+            event.wait()
+
+    def _release(self, idx, coefficient):
+        # Finish the fit claimed by `_acquire`.
+        # `coefficient` is `None` if the fit failed.
+        res = None
+        with self.__lock:
+            try:
+                if coefficient is not None:
+                    res = self._insert_fit(idx, coefficient)
+            finally:
+                self.__pending.pop(idx).set()
+        return res
+
+    def window(self, idx):
+        return self.data[tuple(slice(i, i + s) for (i, s)
+                               in zip(idx, self.fitter.sizes))]
+
+    def _get_fit(self, idx):
+        # idx is the start index
+        res, claimed = self._acquire(idx)
+        if res is not None:
+            return res
+        coefficient = None
+        try:
+            coefficient = self.fitter.fit(self.window(idx)).coefficient
+        finally:
+            res = self._release(idx, coefficient)
         return res
 
+    def _evict(self, idx):
+        # Called by the budget
+        self.cache.pop(idx, None)
+
+    def clear(self):
+        with self.__lock:
+            for idx in list(self.cache):
+                if self.budget is not None:
+                    self.budget.remove(self, idx)
+            self.cache.clear()
+
     def get(self, pos, fit_center=None):
         pos = np.array(pos)
         if fit_center is None:
             fit_center = pos
         kernel_sizes = np.array(self.fitter.sizes)
-        data_sizes = self.data.shape
-        idxs = tuple(_best_fit_idx(n, k, p) for (n, k, p)
-                     in zip(data_sizes, kernel_sizes, fit_center))
-        fit = self.__get_internal(idxs)
+        idxs = self.fit_index(fit_center)
+        fit = self._get_fit(idxs)
         return fit.shift(pos - (kernel_sizes - 1) / 2 - idxs)
 
     def get_single(self, pos, orders, fit_center=None):
@@ -272,12 +706,49 @@ class PolyFitCache:
         if fit_center is None:
             fit_center = pos
         kernel_sizes = np.array(self.fitter.sizes)
-        data_sizes = self.data.shape
-        idxs = tuple(_best_fit_idx(n, k, p) for (n, k, p)
-                     in zip(data_sizes, kernel_sizes, fit_center))
-        fit = self.__get_internal(idxs)
+        idxs = self.fit_index(fit_center)
+        fit = self._get_fit(idxs)
         return fit._shifted_coefficient(pos - (kernel_sizes - 1) / 2 - idxs, orders)
 
+    def get_many(self, pos, fit_center=None):
+        """
+        Batched version of `get` for an `(npoints, ndim)` array of positions
+        (and fit centers).
+
+        The positions are grouped by the fit window they map to so that each
+        distinct window is fitted (or looked up) once.
+        Return the `(npoints, nterms)` array of the shifted coefficients.
+        """
+        ndim = len(self.fitter.sizes)
+        pos = np.reshape(np.asarray(pos, dtype='d'), (-1, ndim))
+        if fit_center is None:
+            fit_center = pos
+        else:
+            fit_center = np.reshape(np.asarray(fit_center, dtype='d'), (-1, ndim))
+        kernel_sizes = np.array(self.fitter.sizes)
+        data_sizes = np.array(self.data.shape)
+        idxs = _best_fit_idxs(data_sizes, kernel_sizes, fit_center)
+        uniq_idxs, inverse = np.unique(idxs, axis=0, return_inverse=True)
+        fits = np.stack([self._get_fit(tuple(int(i) for i in idx)).coefficient
+                         for idx in uniq_idxs])
+        return _shift_coefficient(self.fitter.orders, fits[np.reshape(inverse, -1)],
+                                  pos - (kernel_sizes - 1) / 2 - idxs)
+
     def gradient(self, dim, pos):
         order = tuple(int(i == dim) for i in range(len(self.fitter.sizes)))
         return self.get_single(pos, order)
+
+    def gradient_hessian(self, pos, fit_center=None):
+        """
+        Return the full `(ndim,)` gradient and `(ndim, ndim)` hessian at `pos`
+        from a single fit.
+        """
+        pos = np.array(pos, dtype='d')
+        if fit_center is None:
+            fit_center = pos
+        kernel_sizes = np.array(self.fitter.sizes)
+        idxs = self.fit_index(fit_center)
+        fit = self._get_fit(idxs)
+        _, grad, hess = fit.evaluate(pos - (kernel_sizes - 1) / 2 - idxs,
+                                     gradient=True, hessian=True)
+        return grad[0], hess[0]
@@ -19,38 +19,34 @@
 import numpy as np
 from scipy import optimize
 
-def _optimize_minmax(A, y):
-    """
-    Find the `x` that satisfies `A @ x = y` while having the smallest maximum element.
-    """
-    x0 = np.linalg.lstsq(A, y, rcond=None)[0]
-    ny, nx = A.shape
-    nt = nx - ny
-    if nt <= 0:
-        return x0
+def _null_space(A):
     # With the A @ x = y constraints,
     # the degrees of freedom left in x are the ones that satisfies A * x = 0
     # In another word, these are the x's that are orthogonal to all rows of A.
     # We can find the basis set that spans such space using QR decomposition.
-    B = np.linalg.qr(A.T, mode='complete')[0][:, ny:]
-
-    # Now our job is to find `t` that gives the smallest maximum element in
-    # x0 + B @ t.
+    ny = A.shape[0]
+    return np.linalg.qr(A.T, mode='complete')[0][:, ny:]
 
+def _minmax_constraints(B):
     # Formally, we have `nt + 1` variables including `nt` elements in `t`
     # and `maxv` variable that we'll use to compute the maximum voltage.
-    # The target function is simply to minimize `maxv`.
-    C = np.zeros(nt + 1)
-    C[nt] = 1
     # We have `2 * nx` constraints that corresponds to
     # `maxv >= x0 + B @ t` and `x0 + B @ t >= -maxv`
     # or equivalently
     # `B @ t - maxv <= -x0` and `-B @ t - maxv <= x0`
+    nx, nt = B.shape
     A_ub = np.zeros((nx * 2, nt + 1))
     A_ub[:nx, :nt] = B
     A_ub[nx:, :nt] = -B
     A_ub[:, nt] = -1
+    return A_ub
 
+def _minimize_max(x0, B, A_ub):
+    # Find `t` that gives the smallest maximum element in x0 + B @ t.
+    nx, nt = B.shape
+    # The target function is simply to minimize `maxv`.
+    C = np.zeros(nt + 1)
+    C[nt] = 1
     b_ub = np.zeros(nx * 2)
     b_ub[:nx] = -x0
     b_ub[nx:] = x0
@@ -59,13 +55,31 @@ def _optimize_minmax(A, y):
                            bounds=[(None, None) for i in range(1 + nt)])
     return B @ res.x[:nt] + x0
 
+def _optimize_minmax(A, y):
+    """
+    Find the `x` that satisfies `A @ x = y` while having the smallest maximum element.
+    """
+    x0 = np.linalg.lstsq(A, y, rcond=None)[0]
+    ny, nx = A.shape
+    if nx <= ny:
+        return x0
+    B = _null_space(A)
+    return _minimize_max(x0, B, _minmax_constraints(B))
+
 def optimize_minmax(A, y):
     if y.ndim == 1:
         return _optimize_minmax(A, y)
     ny, nx = A.shape
     assert y.shape[0] == ny
+    # The least square solution, the null space and the constraint matrix
+    # only depend on `A` so they are computed once for all the columns of `y`.
+    x0 = np.linalg.lstsq(A, y, rcond=None)[0]
+    if nx <= ny:
+        return x0
+    B = _null_space(A)
+    A_ub = _minmax_constraints(B)
     nc = y.shape[1]
     res = np.empty((nx, nc))
     for i in range(nc):
-        res[:, i] = _optimize_minmax(A, y[:, i])
+        res[:, i] = _minimize_max(x0[:, i], B, A_ub)
     return res
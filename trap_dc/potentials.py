@@ -16,10 +16,19 @@
 # License along with this library. If not,
 # see <http://www.gnu.org/licenses/>.
 
+import collections
+import concurrent.futures
+import h5py
+import hashlib
+import json
+from multiprocessing import shared_memory
 import numpy as np
-import struct
+import os
+import threading
+import weakref
 
-from .fitting import PolyFitCache
+from .fitting import (CacheBudget, PolyFitCache, math_prod,
+                      _best_fit_idxs, _shift_coefficient)
 
 ##
 # Electrode names for Phoenix and Peregrine
@@ -132,102 +141,163 @@ def _get_electrode_names(aliases, electrode_names, trap):
         return [[name] for name in _raw_electrode_names(trap)]
     return _alias_to_names(aliases, trap)
 
+def _header_dtype(int_type):
+    return np.dtype([('magic', int_type), ('electrodes', int_type),
+                     ('nx', int_type), ('ny', int_type), ('nz', int_type),
+                     ('vsets', int_type)])
+
+def _header_format(int_type, axes):
+    fields = _header_dtype(int_type).descr
+    if axes:
+        fields += [('xaxis', '<d', (3,)), ('yaxis', '<d', (3,))]
+    fields += [('stride', '<d', (3,)), ('origin', '<d', (3,)),
+               # I have no idea what's stored in these
+               ('unknown', int_type, (2,))]
+    return np.dtype(fields), np.dtype(int_type)
+
+# Header format and electrode mapping type for each version of the file format
+_header_formats = {
+    '64': _header_format('<Q', True),
+    'v1': _header_format('<I', True),
+    'v0': _header_format('<I', False),
+}
+_max_header_size = max(fmt[0].itemsize for fmt in _header_formats.values())
+
+def _detect_version(buff, file_size):
+    # Find the version for which the header is consistent with the file size.
+    for (version, (header_dtype, mapping_dtype)) in _header_formats.items():
+        if len(buff) < header_dtype.itemsize:
+            continue
+        header = np.frombuffer(buff, header_dtype, count=1)[0]
+        electrodes = int(header['electrodes'])
+        npoints = int(header['nx']) * int(header['ny']) * int(header['nz'])
+        if electrodes == 0 or npoints == 0:
+            continue
+        expected_size = (header_dtype.itemsize + electrodes * mapping_dtype.itemsize +
+                         electrodes * npoints * 8)
+        if expected_size == file_size:
+            return version
+    raise ValueError("Unable to detect the format of the potential file")
+
+def _crop_ranges(sizes, stride, origin, crop=None, crop_mm=None):
+    """
+    Convert the crop specification to a `(start, stop)` index range for each axis.
+
+    `crop` is in index and `crop_mm` is in mm (at most one of them should be used).
+    Each should have one entry for each axis which is either `None`
+    (no cropping) or a `(start, stop)` pair (either of which can be `None`).
+    Ranges in mm are expanded to include the grid points just outside of them.
+    """
+    assert crop is None or crop_mm is None
+    ranges = []
+    for (i, n) in enumerate(sizes):
+        r = None
+        if crop is not None:
+            r = crop[i]
+        elif crop_mm is not None and crop_mm[i] is not None:
+            i0, i1 = ((None if a is None else (a - origin[i]) / stride[i])
+                      for a in crop_mm[i])
+            if i0 is not None and i1 is not None and i0 > i1:
+                i0, i1 = i1, i0
+            r = (None if i0 is None else max(int(np.floor(i0)), 0),
+                 None if i1 is None else max(int(np.ceil(i1)) + 1, 0))
+        if r is None:
+            r = (None, None)
+        idxs = range(n)[slice(*r)]
+        if len(idxs) == 0:
+            raise ValueError(f"Empty crop range for axis {i}")
+        ranges.append((idxs.start, idxs.stop))
+    return ranges
+
+def _file_identity(filename):
+    st = os.stat(filename)
+    return (os.path.realpath(filename), st.st_size, st.st_mtime_ns)
+
 class RawPotential:
-    @classmethod
-    def import_v0(cls, filename):
-        self = cls()
-        with open(filename, mode="rb") as fh:
-            fh.read(4) # discard
-            self.electrodes = struct.unpack('<I', fh.read(4))[0]
-            self.nx = struct.unpack('<I', fh.read(4))[0]
-            self.ny = struct.unpack('<I', fh.read(4))[0]
-            self.nz = struct.unpack('<I', fh.read(4))[0]
-            vsets = struct.unpack('<I', fh.read(4))[0]
-            # Use mm instead of m
-            self.stride = (1000 * struct.unpack('<d', fh.read(8))[0],
-                           1000 * struct.unpack('<d', fh.read(8))[0],
-                           1000 * struct.unpack('<d', fh.read(8))[0])
-            # Use mm instead of m
-            self.origin = (1000 * struct.unpack('<d', fh.read(8))[0],
-                           1000 * struct.unpack('<d', fh.read(8))[0],
-                           1000 * struct.unpack('<d', fh.read(8))[0])
-            # I have no idea what's stored in these
-            fh.read(4)
-            fh.read(4)
-            self.electrodemapping = np.fromfile(fh, np.dtype('<I'), self.electrodes)
+    def _read_samples(self, fh, mmap, ranges):
+        # With `mmap`, the data is a read-only memory map of the file
+        # so that only the pages actually used are read
+        # (and shared with other processes using the same file).
+        shape = (self.electrodes, self.nx, self.ny, self.nz)
+        nsamples = self.electrodes * self.nx * self.ny * self.nz
+        cropped = ranges != [(0, self.nx), (0, self.ny), (0, self.nz)]
+        slices = (slice(None), *(slice(i0, i1) for (i0, i1) in ranges))
+        offset = fh.tell()
+        if mmap or cropped:
+            if os.fstat(fh.fileno()).st_size - offset != nsamples * 8:
+                raise ValueError("Did not find the right number of samples")
+        if mmap:
+            data = np.memmap(fh, dtype=np.dtype('<d'), mode='r',
+                             offset=offset, shape=shape)
+            return data[slices] if cropped else data
+        if not cropped:
             data = np.fromfile(fh, np.dtype('<d'))
-            if len(data) != self.electrodes * self.nx * self.ny * self.nz:
+            if len(data) != nsamples:
                 raise ValueError("Did not find the right number of samples")
-            self.data = np.reshape(data, (self.electrodes, self.nx, self.ny, self.nz))
-        return self
+            return np.reshape(data, shape)
+        # Only read the range of x for each electrode
+        (x0, x1), (y0, y1), (z0, z1) = ranges
+        data = np.empty((self.electrodes, x1 - x0, y1 - y0, z1 - z0))
+        block = self.ny * self.nz
+        for i in range(self.electrodes):
+            fh.seek(offset + (i * self.nx + x0) * block * 8)
+            slab = np.fromfile(fh, np.dtype('<d'), (x1 - x0) * block)
+            data[i] = np.reshape(slab, (x1 - x0, self.ny, self.nz))[:, y0:y1, z0:z1]
+        return data
 
+    # `crop` and `crop_mm` can be used to read only a region of the grid
+    # (see `_crop_ranges`). The sizes and the origin are adjusted accordingly
+    # and the crop range in the full grid is saved in `crop`.
     @classmethod
-    def import_v1(cls, filename):
+    def _import(cls, filename, version=None, mmap=False, crop=None, crop_mm=None):
         self = cls()
         with open(filename, mode="rb") as fh:
-            fh.read(4) # discard
-            self.electrodes = struct.unpack('<I', fh.read(4))[0]
-            self.nx = struct.unpack('<I', fh.read(4))[0]
-            self.ny = struct.unpack('<I', fh.read(4))[0]
-            self.nz = struct.unpack('<I', fh.read(4))[0]
-            vsets = struct.unpack('<I', fh.read(4))[0]
-            xaxis = (1000 * struct.unpack('<d', fh.read(8))[0],
-                     1000 * struct.unpack('<d', fh.read(8))[0],
-                     1000 * struct.unpack('<d', fh.read(8))[0])
-            yaxis = (1000 * struct.unpack('<d', fh.read(8))[0],
-                     1000 * struct.unpack('<d', fh.read(8))[0],
-                     1000 * struct.unpack('<d', fh.read(8))[0])
+            # Read the header in one shot
+            buff = fh.read(_max_header_size)
+            if version is None:
+                version = _detect_version(buff, os.fstat(fh.fileno()).st_size)
+            header_dtype, mapping_dtype = _header_formats[version]
+            if len(buff) < header_dtype.itemsize:
+                raise ValueError("Incomplete header")
+            header = np.frombuffer(buff, header_dtype, count=1)[0]
+            self.version = version
+            self.source = _file_identity(filename)
+            self.electrodes = int(header['electrodes'])
+            self.nx = int(header['nx'])
+            self.ny = int(header['ny'])
+            self.nz = int(header['nz'])
             # Use mm instead of m
-            self.stride = (1000 * struct.unpack('<d', fh.read(8))[0],
-                           1000 * struct.unpack('<d', fh.read(8))[0],
-                           1000 * struct.unpack('<d', fh.read(8))[0])
-            # Use mm instead of m
-            self.origin = (1000 * struct.unpack('<d', fh.read(8))[0],
-                           1000 * struct.unpack('<d', fh.read(8))[0],
-                           1000 * struct.unpack('<d', fh.read(8))[0])
-            # I have no idea what's stored in these
-            fh.read(4)
-            fh.read(4)
-            self.electrodemapping = np.fromfile(fh, np.dtype('<I'), self.electrodes)
-            data = np.fromfile(fh, np.dtype('<d'))
-            if len(data) != self.electrodes * self.nx * self.ny * self.nz:
-                raise ValueError("Did not find the right number of samples")
-            self.data = np.reshape(data, (self.electrodes, self.nx, self.ny, self.nz))
+            self.stride = tuple(1000 * float(v) for v in header['stride'])
+            origin = tuple(1000 * float(v) for v in header['origin'])
+            ranges = _crop_ranges((self.nx, self.ny, self.nz), self.stride, origin,
+                                  crop=crop, crop_mm=crop_mm)
+            fh.seek(header_dtype.itemsize)
+            self.electrodemapping = np.fromfile(fh, mapping_dtype, self.electrodes)
+            self.data = self._read_samples(fh, mmap, ranges)
+        self.crop = tuple(ranges)
+        self.nx, self.ny, self.nz = (i1 - i0 for (i0, i1) in ranges)
+        self.origin = tuple(o + i0 * s for (o, (i0, i1), s)
+                            in zip(origin, ranges, self.stride))
         return self
 
     @classmethod
-    def import_64(cls, filename):
-        self = cls()
-        with open(filename, mode="rb") as fh:
-            fh.read(8) # discard
-            self.electrodes = struct.unpack('<Q', fh.read(8))[0]
-            self.nx = struct.unpack('<Q', fh.read(8))[0]
-            self.ny = struct.unpack('<Q', fh.read(8))[0]
-            self.nz = struct.unpack('<Q', fh.read(8))[0]
-            vsets = struct.unpack('<Q', fh.read(8))[0]
-            xaxis = (1000 * struct.unpack('<d', fh.read(8))[0],
-                     1000 * struct.unpack('<d', fh.read(8))[0],
-                     1000 * struct.unpack('<d', fh.read(8))[0])
-            yaxis = (1000 * struct.unpack('<d', fh.read(8))[0],
-                     1000 * struct.unpack('<d', fh.read(8))[0],
-                     1000 * struct.unpack('<d', fh.read(8))[0])
-            # Use mm instead of m
-            self.stride = (1000 * struct.unpack('<d', fh.read(8))[0],
-                           1000 * struct.unpack('<d', fh.read(8))[0],
-                           1000 * struct.unpack('<d', fh.read(8))[0])
-            # Use mm instead of m
-            self.origin = (1000 * struct.unpack('<d', fh.read(8))[0],
-                           1000 * struct.unpack('<d', fh.read(8))[0],
-                           1000 * struct.unpack('<d', fh.read(8))[0])
-            # I have no idea what's stored in these
-            fh.read(8)
-            fh.read(8)
-            electrodemapping = np.fromfile(fh, np.dtype('<Q'), self.electrodes)
-            data = np.fromfile(fh, np.dtype('<d'))
-            if len(data) != self.electrodes * self.nx * self.ny * self.nz:
-                raise ValueError("Did not find the right number of samples")
-            self.data = np.reshape(data, (self.electrodes, self.nx, self.ny, self.nz))
-        return self
+    def import_v0(cls, filename, mmap=False, crop=None, crop_mm=None):
+        return cls._import(filename, 'v0', mmap=mmap, crop=crop, crop_mm=crop_mm)
+
+    @classmethod
+    def import_v1(cls, filename, mmap=False, crop=None, crop_mm=None):
+        return cls._import(filename, 'v1', mmap=mmap, crop=crop, crop_mm=crop_mm)
+
+    @classmethod
+    def import_64(cls, filename, mmap=False, crop=None, crop_mm=None):
+        return cls._import(filename, '64', mmap=mmap, crop=crop, crop_mm=crop_mm)
+
+    @classmethod
+    def load(cls, filename, mmap=False, crop=None, crop_mm=None):
+        """
+        Load the potential file after detecting the version of the file format.
+        """
+        return cls._import(filename, mmap=mmap, crop=crop, crop_mm=crop_mm)
 
     def x_index_to_axis(self, i):
         return i * self.stride[0] + self.origin[0]
@@ -243,66 +313,788 @@ class RawPotential:
     def z_axis_to_index(self, a):
         return (a - self.origin[2]) / self.stride[2]
 
+class LazyElectrodeData:
+    """
+    Array-like object for the `(electrodes, nx, ny, nz)` potential data where the
+    data for each electrode is only materialized on first access.
+
+    Indexing with an integer as the first index materializes (and caches)
+    only the data for that electrode. At most `max_cached` electrodes
+    are kept (in least-recently-used order) if it is not `None`,
+    and the cached ones can be dropped explicitly with `evict`.
+    Subclasses implement `_load` to compute the data for one electrode.
+    The data can be accessed from multiple threads.
+    """
+    def __init__(self, shape, dtype, max_cached=None):
+        self.shape = tuple(shape)
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(dtype)
+        self.max_cached = max_cached
+        self.__cache = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def _load(self, ele):
+        raise NotImplementedError
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def cached(self):
+        with self.__lock:
+            return list(self.__cache.keys())
+
+    def get(self, ele):
+        ele = range(self.shape[0])[ele]
+        with self.__lock:
+            res = self.__cache.get(ele)
+            if res is not None:
+                self.__cache.move_to_end(ele)
+                return res
+        # Load without holding the lock so that different electrodes
+        # can be loaded concurrently.
+        res = self._load(ele)
+        with self.__lock:
+            self.__cache[ele] = res
+            if self.max_cached is not None:
+                while len(self.__cache) > max(self.max_cached, 1):
+                    self.__cache.popitem(last=False)
+        return res
+
+    def evict(self, ele=None):
+        with self.__lock:
+            if ele is None:
+                self.__cache.clear()
+            else:
+                self.__cache.pop(range(self.shape[0])[ele], None)
+
+    def __getitem__(self, idx):
+        if not isinstance(idx, tuple):
+            idx = (idx,)
+        ele = idx[0]
+        if isinstance(ele, (int, np.integer)):
+            return self.get(ele)[idx[1:]]
+        eles = np.arange(self.shape[0])[ele]
+        return np.stack([self.get(e) for e in eles])[(slice(None), *idx[1:])]
+
+    def __array__(self, dtype=None, copy=None):
+        # Materialize everything without populating the cache
+        res = np.empty(self.shape, self.dtype)
+        for ele in range(self.shape[0]):
+            data = self.__cache.get(ele)
+            res[ele] = self._load(ele) if data is None else data
+        if dtype is not None:
+            res = res.astype(dtype, copy=False)
+        return res
+
+class LazyElectrodeView:
+    """
+    Array-like view of the data for the electrode `ele` in the `LazyElectrodeData`
+    `data`. The data is looked up from `data` on each access instead of being held
+    by the view so that `max_cached` and `evict` still limit the memory used by
+    the electrode data while e.g. a `FitCache` is alive.
+    """
+    def __init__(self, data, ele):
+        self.data = data
+        self.ele = ele
+        self.shape = data.shape[1:]
+        self.ndim = len(self.shape)
+        self.dtype = data.dtype
+
+    def __getitem__(self, idx):
+        if not isinstance(idx, tuple):
+            idx = (idx,)
+        return self.data[(self.ele, *idx)]
+
+    def __array__(self, dtype=None, copy=None):
+        res = self.data.get(self.ele)
+        if dtype is not None:
+            res = res.astype(dtype, copy=False)
+        return res
+
+class AliasedElectrodeData(LazyElectrodeData):
+    """
+    Lazily sum up the data for the raw electrodes that are shorted together.
+
+    The sum is always computed in double precision before being converted
+    to `dtype` (if specified).
+    """
+    def __init__(self, raw_data, raw_indices, max_cached=None, dtype=None):
+        if dtype is None:
+            dtype = np.result_type(raw_data.dtype, np.float64)
+        super().__init__((len(raw_indices), *raw_data.shape[1:]),
+                         dtype, max_cached=max_cached)
+        self.raw_data = raw_data
+        self.raw_indices = raw_indices
+
+    def _load(self, ele):
+        raw_idxs = self.raw_indices[ele]
+        res = np.array(self.raw_data[raw_idxs[0]], dtype=np.float64)
+        for raw_idx in raw_idxs[1:]:
+            res += self.raw_data[raw_idx]
+        return res.astype(self.dtype, copy=False)
+
+class H5ElectrodeData(LazyElectrodeData):
+    """
+    Lazily read the data for each electrode (within the `(start, stop)`
+    index range for each axis in `ranges`) from the dataset written by
+    `Potential.export_chunked`.
+    """
+    def __init__(self, dataset, ranges, max_cached=None, dtype=None):
+        super().__init__((dataset.shape[0], *(i1 - i0 for (i0, i1) in ranges)),
+                         dataset.dtype if dtype is None else dtype,
+                         max_cached=max_cached)
+        self.dataset = dataset
+        self.ranges = tuple(ranges)
+
+    def _load(self, ele):
+        res = self.dataset[(ele, *(slice(i0, i1) for (i0, i1) in self.ranges))]
+        return res.astype(self.dtype, copy=False)
+
+# Picklable description of a potential published in shared memory
+# with `Potential.to_shared_memory`.
+SharedPotential = collections.namedtuple('SharedPotential',
+                                         ['name', 'shape', 'dtype',
+                                          'electrode_names', 'stride', 'origin',
+                                          'source', 'crop'])
+
 class Potential(RawPotential):
-    def __init_alias(self, electrode_names, trap):
+    # The `multiprocessing.shared_memory.SharedMemory` backing the data, if any
+    # (see `to_shared_memory` and `from_shared_memory`)
+    shared_memory = None
+    # The HDF5 file the data is read from, if any (see `import_chunked`)
+    file = None
+
+    def close(self):
+        """
+        Close the file the data is read from (for `import_chunked`).
+        The data that isn't loaded yet is no longer accessible afterwards.
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __init_alias(self, electrode_names, trap, lazy=False, max_cached=None,
+                     dtype=None):
         raw_electrode_names = _raw_electrode_names(trap)
         raw_electrode_index = _raw_electrode_index(trap)
         assert self.electrodes == len(raw_electrode_names)
         new_electrodes = len(electrode_names)
-        new_data = np.empty((new_electrodes, self.nx, self.ny, self.nz))
+        if ((dtype is None or np.dtype(dtype) == self.data.dtype) and
+            new_electrodes == self.electrodes and
+            all(names == [raw_name] for (names, raw_name)
+                in zip(electrode_names, raw_electrode_names))):
+            # No aliases, use the raw data directly (which avoids a copy and
+            # keeps the memory map if there is one).
+            self.electrode_index = {name[0]: i
+                                    for (i, name) in enumerate(electrode_names)}
+            self.electrode_names = electrode_names
+            return
         electrode_index = {}
+        raw_indices = []
         for i in range(new_electrodes):
             electrodes = electrode_names[i]
-            first = True
+            assert electrodes
             for elec in electrodes:
                 electrode_index[elec] = i
-                raw_idx = raw_electrode_index[elec]
-                if first:
-                    new_data[i, :, :, :] = self.data[raw_idx, :, :, :]
-                    first = False
-                else:
-                    new_data[i, :, :, :] += self.data[raw_idx, :, :, :]
-            assert not first
+            raw_indices.append([raw_electrode_index[elec] for elec in electrodes])
+        new_data = AliasedElectrodeData(self.data, raw_indices, max_cached=max_cached,
+                                        dtype=dtype)
+        if not lazy:
+            new_data = np.asarray(new_data)
         self.data = new_data
         self.electrodes = new_electrodes
         self.electrode_index = electrode_index
         self.electrode_names = electrode_names
 
+    # With `lazy`, the data for each electrode after taking the aliases
+    # into account is only computed when it is first accessed.
+    # `max_cached` limits the number of electrodes that are kept in that case.
+    # `dtype` can be used to store the data in a different precision,
+    # e.g. `np.float32` to halve the memory usage (see `FitCache` for the effect
+    # on the precision of the fits).
+    @classmethod
+    def import_v0(cls, filename, trap="phoenix", aliases=None, electrode_names=None,
+                  mmap=False, lazy=False, max_cached=None, crop=None, crop_mm=None,
+                  dtype=None):
+        self = super(Potential, cls).import_v0(filename, mmap=mmap,
+                                                crop=crop, crop_mm=crop_mm)
+        self.__init_alias(_get_electrode_names(aliases, electrode_names, trap), trap,
+                          lazy=lazy, max_cached=max_cached, dtype=dtype)
+        return self
+
     @classmethod
-    def import_v0(cls, filename, trap="phoenix", aliases=None, electrode_names=None):
-        self = super(Potential, cls).import_v0(filename)
-        self.__init_alias(_get_electrode_names(aliases, electrode_names, trap), trap)
+    def import_v1(cls, filename, trap="phoenix", aliases=None, electrode_names=None,
+                  mmap=False, lazy=False, max_cached=None, crop=None, crop_mm=None,
+                  dtype=None):
+        self = super(Potential, cls).import_v1(filename, mmap=mmap,
+                                                crop=crop, crop_mm=crop_mm)
+        self.__init_alias(_get_electrode_names(aliases, electrode_names, trap), trap,
+                          lazy=lazy, max_cached=max_cached, dtype=dtype)
         return self
 
     @classmethod
-    def import_v1(cls, filename, trap="phoenix", aliases=None, electrode_names=None):
-        self = super(Potential, cls).import_v1(filename)
-        self.__init_alias(_get_electrode_names(aliases, electrode_names, trap), trap)
+    def import_64(cls, filename, trap="phoenix", aliases=None, electrode_names=None,
+                  mmap=False, lazy=False, max_cached=None, crop=None, crop_mm=None,
+                  dtype=None):
+        self = super(Potential, cls).import_64(filename, mmap=mmap,
+                                                crop=crop, crop_mm=crop_mm)
+        self.__init_alias(_get_electrode_names(aliases, electrode_names, trap), trap,
+                          lazy=lazy, max_cached=max_cached, dtype=dtype)
+        return self
+
+    @classmethod
+    def load(cls, filename, trap="phoenix", aliases=None, electrode_names=None,
+             mmap=False, lazy=False, max_cached=None, crop=None, crop_mm=None,
+             dtype=None):
+        """
+        Same as the `import_*` functions but detects the version of the file format.
+        """
+        self = super(Potential, cls).load(filename, mmap=mmap,
+                                          crop=crop, crop_mm=crop_mm)
+        self.__init_alias(_get_electrode_names(aliases, electrode_names, trap), trap,
+                          lazy=lazy, max_cached=max_cached, dtype=dtype)
+        return self
+
+    def export_chunked(self, filename, chunk_x=128, compression=None):
+        """
+        Save the (aliased) potential to a HDF5 file chunked so that
+        each chunk covers the full y/z range of `chunk_x` points in x
+        for a single electrode, which makes it cheap to read back only
+        the electrodes and x ranges needed for fitting.
+        `compression` is passed to `h5py` (e.g. `"gzip"` or `"lzf"`).
+        """
+        shape = (self.electrodes, self.nx, self.ny, self.nz)
+        chunks = (1, min(chunk_x, self.nx), self.ny, self.nz)
+        with h5py.File(filename, 'w') as fh:
+            fh.create_dataset("electrode_names", data=json.dumps(self.electrode_names))
+            fh.attrs['stride'] = self.stride
+            fh.attrs['origin'] = self.origin
+            ds = fh.create_dataset("data", shape=shape, dtype=self.data.dtype,
+                                   chunks=chunks, compression=compression)
+            for i in range(self.electrodes):
+                ds[i] = self.data[i]
+
+    @classmethod
+    def import_chunked(cls, filename, electrodes=None, x_range=None, max_cached=None,
+                       crop=None, crop_mm=None, dtype=None):
+        """
+        Open a file written by `export_chunked`.
+
+        The data for each electrode is only read when it is first accessed
+        (see `LazyElectrodeData`), except for the ones in `electrodes`
+        which are read right away. Only the data within `x_range`
+        (a `(start, stop)` pair of x indices) is read if specified.
+        More generally, `crop` and `crop_mm` can be used to select the region
+        to read in the same way as the `import_*` functions.
+        The file is kept open until `close` is called
+        (or the potential is used as a context manager).
+        """
+        self = cls()
+        self.source = _file_identity(filename)
+        fh = h5py.File(filename, 'r')
+        self.file = fh
+        self.electrode_names = json.loads(fh["electrode_names"][()])
+        self.electrode_index = {name: i for (i, names)
+                                in enumerate(self.electrode_names)
+                                for name in names}
+        ds = fh["data"]
+        self.electrodes = ds.shape[0]
+        self.stride = tuple(float(v) for v in fh.attrs['stride'])
+        origin = tuple(float(v) for v in fh.attrs['origin'])
+        if x_range is not None:
+            assert crop_mm is None and (crop is None or crop[0] is None)
+            crop = (x_range, *((None, None) if crop is None else crop[1:]))
+        ranges = _crop_ranges(ds.shape[1:], self.stride, origin,
+                              crop=crop, crop_mm=crop_mm)
+        self.crop = tuple(ranges)
+        self.nx, self.ny, self.nz = (i1 - i0 for (i0, i1) in ranges)
+        self.origin = tuple(o + i0 * s for (o, (i0, i1), s)
+                            in zip(origin, ranges, self.stride))
+        self.data = H5ElectrodeData(ds, ranges, max_cached=max_cached, dtype=dtype)
+        if electrodes is not None:
+            for ele in electrodes:
+                if not isinstance(ele, int):
+                    ele = self.electrode_index[ele]
+                self.data.get(ele)
         return self
 
+    def content_key(self):
+        """
+        A hash identifying the potential data.
+
+        This is computed from the identity of the file the potential is loaded from
+        (path, size and modification time), the crop range and the electrode
+        aliases if available and from the data itself otherwise.
+        The type the data is stored as is always included so that e.g. fits
+        computed from `np.float32` data are not used for the `np.float64` data.
+        """
+        h = hashlib.sha256()
+        source = getattr(self, 'source', None)
+        dtype = np.dtype(self.data.dtype).str
+        if source is not None:
+            h.update(json.dumps([source, getattr(self, 'crop', None),
+                                 self.electrode_names, dtype]).encode())
+        else:
+            h.update(json.dumps([self.stride, self.origin,
+                                 self.electrode_names, dtype]).encode())
+            for i in range(self.electrodes):
+                h.update(np.ascontiguousarray(self.data[i]).tobytes())
+        return h.hexdigest()
+
+    def __shared_handle(self):
+        return SharedPotential(self.shared_memory.name, self.data.shape,
+                               self.data.dtype.str, self.electrode_names,
+                               self.stride, self.origin,
+                               getattr(self, 'source', None),
+                               getattr(self, 'crop', None))
+
+    def to_shared_memory(self):
+        """
+        Copy the potential data into a new `multiprocessing.shared_memory` block
+        and return a picklable `SharedPotential` handle.
+        The handle can be passed to other processes which can then
+        use `from_shared_memory` to access the data without making a copy.
+
+        The data of this potential is replaced by the shared copy so that
+        the data isn't duplicated in this process either.
+        Lazy data is materialized one electrode at a time.
+        The shared memory is owned by this potential and should be released
+        with `close_shared_memory(unlink=True)` once all the users are done.
+        """
+        if self.shared_memory is not None:
+            return self.__shared_handle()
+        shape = (self.electrodes, self.nx, self.ny, self.nz)
+        dtype = np.dtype(self.data.dtype)
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=max(math_prod(shape) * dtype.itemsize, 1))
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        for i in range(self.electrodes):
+            data[i] = self.data[i]
+        self.data = data
+        self.shared_memory = shm
+        return self.__shared_handle()
+
     @classmethod
-    def import_64(cls, filename, trap="phoenix", aliases=None, electrode_names=None):
-        self = super(Potential, cls).import_64(filename)
-        self.__init_alias(_get_electrode_names(aliases, electrode_names, trap), trap)
+    def from_shared_memory(cls, handle):
+        """
+        Attach to the potential published with `to_shared_memory`.
+
+        The data is a read-only view of the shared memory.
+        The returned potential keeps the shared memory mapped
+        until `close_shared_memory` is called.
+        """
+        try:
+            # Do not let the resource tracker of this process unlink
+            # the memory owned by the publisher when we exit.
+            shm = shared_memory.SharedMemory(name=handle.name, track=False)
+        except TypeError:
+            shm = shared_memory.SharedMemory(name=handle.name)
+        self = cls()
+        self.shared_memory = shm
+        self.data = np.ndarray(handle.shape, dtype=np.dtype(handle.dtype),
+                               buffer=shm.buf)
+        self.data.flags.writeable = False
+        self.electrodes, self.nx, self.ny, self.nz = handle.shape
+        self.electrode_names = handle.electrode_names
+        self.electrode_index = {name: i for (i, names)
+                                in enumerate(self.electrode_names)
+                                for name in names}
+        self.stride = handle.stride
+        self.origin = handle.origin
+        # Keep the identity of the original file so that `content_key`
+        # matches the one of the published potential.
+        if handle.source is not None:
+            self.source = handle.source
+            self.crop = handle.crop
         return self
 
-    def get_cache(self, fitter):
-        return FitCache(fitter, self)
+    def close_shared_memory(self, unlink=False):
+        """
+        Release the shared memory used by this potential.
+        The data is no longer accessible afterwards and any views of it
+        (including the ones held by `FitCache`) must be dropped first.
+        With `unlink`, the shared memory is also freed, which should only
+        be done by the publisher after all the other processes are done with it.
+        Does nothing if the potential does not use shared memory.
+        """
+        shm = self.shared_memory
+        if shm is None:
+            return
+        self.shared_memory = None
+        self.data = None
+        shm.close()
+        if unlink:
+            shm.unlink()
+
+    def get_cache(self, fitter, **kwargs):
+        return FitCache(fitter, self, **kwargs)
+
+class FitStore:
+    """
+    Persistent storage of the fits in a HDF5 file.
+
+    The fits are stored in a group for each potential (`Potential.content_key`),
+    fitter parameters and electrode. Each group holds a dense `fits` dataset
+    indexed by the start index of the fit window (with the coefficients
+    along the last axis) and a `done` mask of the windows that have been stored.
+
+    New fits are buffered and written in batches of `batch_size`.
+    The remaining ones are written by `flush` or `close`.
+    """
+    def __init__(self, filename, batch_size=8192):
+        self.file = h5py.File(filename, 'a')
+        self.batch_size = batch_size
+        self.lock = threading.RLock()
+        self.__groups = {}
+        self.__npending = 0
+
+    def flush(self):
+        with self.lock:
+            for group in self.__groups.values():
+                group._write()
+            self.__npending = 0
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.flush()
+                self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def group(self, potential_key, fitter, ele, shape):
+        """
+        The storage for the fits of electrode `ele` of the potential
+        with the data `shape`.
+        """
+        fitter_key = json.dumps([[int(v) for v in fitter.orders],
+                                 [int(v) for v in fitter.sizes],
+                                 [float(v) for v in fitter.center]])
+        fitter_key = hashlib.sha256(fitter_key.encode()).hexdigest()
+        path = f"{potential_key}/{fitter_key}/{ele}"
+        with self.lock:
+            group = self.__groups.get(path)
+            if group is None:
+                nstarts = tuple(int(n) - int(s) + 1
+                                for (n, s) in zip(shape, fitter.sizes))
+                group = FitStoreGroup(self, path, nstarts, len(fitter.projection))
+                self.__groups[path] = group
+            return group
+
+    def _buffered(self):
+        # Called by the groups (with the lock held) for each new fit.
+        self.__npending += 1
+        if self.__npending >= self.batch_size:
+            self.flush()
+
+class FitStoreGroup:
+    # The `done` mask is kept in memory. The fits are read from the file
+    # in blocks of `block_size` consecutive window starts along the first axis
+    # (which is also the chunk size of the datasets) and the last `max_blocks`
+    # blocks read are kept in memory.
+    block_size = 64
+    max_blocks = 8
+
+    def __init__(self, store, path, nstarts, nterms):
+        self.store = store
+        self.path = path
+        self.nstarts = nstarts
+        group = store.file.require_group(path)
+        if "fits" in group:
+            self.fits = group["fits"]
+            self.done = group["done"]
+            assert self.fits.shape == (*nstarts, nterms)
+            self.block_size = self.fits.chunks[0]
+        else:
+            self.block_size = min(self.block_size, nstarts[0])
+            chunks = (self.block_size, *(1 for n in nstarts[1:]))
+            self.fits = group.create_dataset("fits", shape=(*nstarts, nterms),
+                                             dtype='d', chunks=(*chunks, nterms))
+            self.done = group.create_dataset("done", shape=nstarts, dtype=bool,
+                                             chunks=chunks)
+        self.__done = self.done[()]
+        self.__blocks = collections.OrderedDict()
+        self.__pending = {}
+
+    def __block(self, idx):
+        start = idx[0] // self.block_size * self.block_size
+        key = (start, *idx[1:])
+        block = self.__blocks.get(key)
+        if block is None:
+            block = self.fits[(slice(start, start + self.block_size), *idx[1:])]
+            self.__blocks[key] = block
+            while len(self.__blocks) > self.max_blocks:
+                self.__blocks.popitem(last=False)
+        else:
+            self.__blocks.move_to_end(key)
+        return block, idx[0] - start
+
+    def load(self, idx):
+        idx = tuple(int(i) for i in idx)
+        with self.store.lock:
+            if not self.__done[idx]:
+                return
+            coefficient = self.__pending.get(idx)
+            if coefficient is not None:
+                return coefficient
+            (block, i) = self.__block(idx)
+            return block[i].copy()
+
+    def save(self, idx, coefficient):
+        idx = tuple(int(i) for i in idx)
+        with self.store.lock:
+            self.__pending[idx] = np.array(coefficient, dtype='d')
+            self.__done[idx] = True
+            self.store._buffered()
+
+    def _write(self):
+        # Write the buffered fits with one write for each run of consecutive
+        # window starts along the first axis.
+        if not self.__pending:
+            return
+        rows = collections.defaultdict(list)
+        for idx in self.__pending:
+            rows[idx[1:]].append(idx[0])
+        for (rest, starts) in rows.items():
+            starts.sort()
+            run_start = 0
+            for i in range(1, len(starts) + 1):
+                if i < len(starts) and starts[i] == starts[i - 1] + 1:
+                    continue
+                sel = (slice(starts[run_start], starts[i - 1] + 1), *rest)
+                self.fits[sel] = np.stack([self.__pending[(j, *rest)] for j
+                                           in starts[run_start:i]])
+                self.done[sel] = np.ones(i - run_start, dtype=bool)
+                run_start = i
+        for (idx, coefficient) in self.__pending.items():
+            start = idx[0] // self.block_size * self.block_size
+            block = self.__blocks.get((start, *idx[1:]))
+            if block is not None:
+                block[idx[0] - start] = coefficient
+        self.__pending.clear()
 
 class FitCache:
-    def __init__(self, fitter, potential):
+    # `max_entries` and `max_bytes` limit the number/size of the cached fits.
+    # With `shared_budget` (the default) the limit applies to the fits for all
+    # the electrodes together, otherwise it applies to each electrode separately.
+    # A `CacheBudget` can also be passed in directly as `budget`.
+    # `dtype` is the type used to store the fitted coefficients
+    # (see `PolyFitCache`).
+    #
+    # With `np.float32` storage for both the potential and the fits,
+    # each sample and each cached coefficient has a relative rounding error
+    # of at most `2**-24`. The fits themselves are still done in double precision,
+    # so the error of each fitted coefficient `c[i]` is bounded by
+    # `fitter.error_bound(max(abs(window)), 2**-24)[i] + abs(c[i]) * 2**-24`.
+    # Since the shift and the compensation terms are linear maps
+    # of the coefficients, the errors in e.g. the `CompensateTerms1/2` outputs
+    # are bounded by applying the absolute value of the maps to this bound.
+    #
+    # `store` is a `FitStore` (or the file name for one) used to persist the fits
+    # across processes. Fits found in the store are loaded instead of recomputed.
+    # New fits are written to the store in batches, `flush` (or closing the store)
+    # writes the remaining ones. A store opened from a file name is owned
+    # by the cache and is closed by `close` (or the context manager),
+    # or otherwise when the cache is garbage collected or the interpreter exits.
+    #
+    # The cache can be used from multiple threads. Since the fitting is mostly
+    # done in BLAS, which releases the GIL, `warm` can be used to fill the cache
+    # in parallel before e.g. a sweep.
+    def __init__(self, fitter, potential, max_entries=None, max_bytes=None,
+                 budget=None, shared_budget=True, dtype=None, store=None):
         self.fitter = fitter
         self.potential = potential
         self.cache = {}
+        self.dtype = dtype
+        self.__finalizer = None
+        if store is not None and not isinstance(store, FitStore):
+            store = FitStore(store)
+            self.__finalizer = weakref.finalize(self, store.close)
+        self.store = store
+        self.__potential_key = None
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        if (budget is None and shared_budget and
+            (max_entries is not None or max_bytes is not None)):
+            budget = CacheBudget(max_entries=max_entries, max_bytes=max_bytes)
+        self.budget = budget
+        self.__lock = threading.Lock()
+
+    def __get_store(self, ele):
+        if self.store is None:
+            return
+        if self.__potential_key is None:
+            self.__potential_key = self.potential.content_key()
+        return self.store.group(self.__potential_key, self.fitter, ele,
+                                self.potential.data.shape[1:])
 
     def __get_internal(self, ele):
         if not isinstance(ele, int):
             ele = self.potential.electrode_index[ele]
-        if ele in self.cache:
-            return self.cache[ele]
-        res = PolyFitCache(self.fitter, self.potential.data[ele, :, :, :])
-        self.cache[ele] = res
-        return res
+        res = self.cache.get(ele)
+        if res is not None:
+            return res
+        with self.__lock:
+            res = self.cache.get(ele)
+            if res is not None:
+                return res
+            data = self.potential.data
+            if isinstance(data, LazyElectrodeData):
+                # Only resolve the electrode data when fitting a window
+                data = LazyElectrodeView(data, ele)
+            else:
+                data = data[ele, :, :, :]
+            res = PolyFitCache(self.fitter, data,
+                               max_entries=self.max_entries, max_bytes=self.max_bytes,
+                               budget=self.budget, dtype=self.dtype,
+                               store=self.__get_store(ele))
+            self.cache[ele] = res
+            return res
+
+    def __fit_window(self, fit_caches, idx):
+        # Return the unshifted coefficients for the window starting at `idx`
+        # for all of `fit_caches`.
+        # The windows that aren't available are claimed and fitted together.
+        # The ones that are being fitted by other threads are waited for
+        # only after our own fits are done, so that two threads working on
+        # overlapping sets of electrodes cannot wait for each other.
+        coefficients = np.empty((len(fit_caches), len(self.fitter.projection)))
+        missing = []
+        waiting = []
+        for (i, fit_cache) in enumerate(fit_caches):
+            res, claimed = fit_cache._acquire(idx, wait=False)
+            if res is not None:
+                coefficients[i] = res.coefficient
+            elif claimed:
+                missing.append(i)
+            else:
+                waiting.append(i)
+        if missing:
+            fits = None
+            try:
+                windows = np.stack([fit_caches[i].window(idx) for i in missing])
+                fits = self.fitter.fit_many(windows)
+            finally:
+                for (j, i) in enumerate(missing):
+                    res = fit_caches[i]._release(idx, None if fits is None
+                                                 else fits[j])
+                    if res is not None:
+                        coefficients[i] = res.coefficient
+        for i in waiting:
+            coefficients[i] = fit_caches[i]._get_fit(idx).coefficient
+        return coefficients
+
+    def get_all(self, electrodes, pos, fit_center=None):
+        """
+        Get the fits for all the `electrodes` at `pos`.
+
+        Since the fit window is the same for all the electrodes,
+        the windows for all the electrodes that aren't already cached
+        are fitted together and all the results are shifted together.
+        Return the `(nelectrodes, nterms)` coefficient array.
+        """
+        fit_caches = [self.__get_internal(ele) for ele in electrodes]
+        nterms = len(self.fitter.projection)
+        if not fit_caches:
+            return np.empty((0, nterms))
+        pos = np.array(pos, dtype='d')
+        if fit_center is None:
+            fit_center = pos
+        idx = fit_caches[0].fit_index(fit_center)
+        coefficients = self.__fit_window(fit_caches, idx)
+        return _shift_coefficient(self.fitter.orders, coefficients,
+                                  pos - (np.array(self.fitter.sizes) - 1) / 2 - idx)
+
+    def get_all_many(self, electrodes, pos, fit_center=None):
+        """
+        Batched version of `get_all` for an `(npoints, 3)` array of positions
+        (and fit centers).
+
+        Each distinct fit window is fitted (or looked up) once for all the electrodes.
+        Return the `(npoints, nelectrodes, nterms)` coefficient array.
+        """
+        fit_caches = [self.__get_internal(ele) for ele in electrodes]
+        nterms = len(self.fitter.projection)
+        pos = np.reshape(np.asarray(pos, dtype='d'), (-1, 3))
+        if fit_center is None:
+            fit_center = pos
+        else:
+            fit_center = np.reshape(np.asarray(fit_center, dtype='d'), (-1, 3))
+        if not fit_caches:
+            return np.empty((len(pos), 0, nterms))
+        kernel_sizes = np.array(self.fitter.sizes)
+        idxs = _best_fit_idxs(np.array(fit_caches[0].data.shape), kernel_sizes,
+                              fit_center)
+        uniq_idxs, inverse = np.unique(idxs, axis=0, return_inverse=True)
+        fits = np.stack([self.__fit_window(fit_caches, tuple(int(i) for i in idx))
+                         for idx in uniq_idxs])
+        shift = pos - (kernel_sizes - 1) / 2 - idxs
+        return _shift_coefficient(self.fitter.orders, fits[np.reshape(inverse, -1)],
+                                  shift[:, None, :])
+
+    def warm(self, electrodes, positions, workers=None):
+        """
+        Fill the cache with the fits for all the `electrodes` needed to
+        evaluate at the `(npoints, 3)` `positions`.
+
+        Each distinct fit window is fitted once for all the electrodes
+        and the windows are processed concurrently by a pool of `workers` threads
+        (the default of `concurrent.futures.ThreadPoolExecutor` if `None`).
+        Return the number of distinct windows.
+        """
+        fit_caches = [self.__get_internal(ele) for ele in electrodes]
+        if not fit_caches:
+            return 0
+        positions = np.reshape(np.asarray(positions, dtype='d'), (-1, 3))
+        idxs = _best_fit_idxs(np.array(fit_caches[0].data.shape),
+                              np.array(self.fitter.sizes), positions)
+        idxs = [tuple(int(i) for i in idx) for idx in np.unique(idxs, axis=0)]
+        if workers == 1:
+            for idx in idxs:
+                self.__fit_window(fit_caches, idx)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                for _ in pool.map(lambda idx: self.__fit_window(fit_caches, idx),
+                                  idxs):
+                    pass
+        if self.store is not None:
+            self.store.flush()
+        return len(idxs)
+
+    def flush(self):
+        """
+        Write the buffered fits to the `store`, if any.
+        """
+        if self.store is not None:
+            self.store.flush()
+
+    def close(self):
+        """
+        Close the `store` if it was opened by this cache,
+        otherwise write the buffered fits to it.
+        """
+        if self.__finalizer is not None:
+            self.__finalizer()
+        else:
+            self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def get(self, ele, *args, **kwargs):
         fit_cache = self.__get_internal(ele)
@@ -310,6 +1102,10 @@ class FitCache:
             return fit_cache.get(*args, **kwargs)
         return fit_cache
 
+    def get_many(self, ele, *args, **kwargs):
+        fit_cache = self.__get_internal(ele)
+        return fit_cache.get_many(*args, **kwargs)
+
     def get_single(self, ele, *args, **kwargs):
         fit_cache = self.__get_internal(ele)
         return fit_cache.get_single(*args, **kwargs)
@@ -317,3 +1113,11 @@ class FitCache:
     def gradient(self, ele, *args, **kwargs):
         fit_cache = self.__get_internal(ele)
         return fit_cache.gradient(*args, **kwargs)
+
+    def fill_field(self, ele, *args, **kwargs):
+        fit_cache = self.__get_internal(ele)
+        return fit_cache.fill_field(*args, **kwargs)
+
+    def gradient_hessian(self, ele, *args, **kwargs):
+        fit_cache = self.__get_internal(ele)
+        return fit_cache.gradient_hessian(*args, **kwargs)
@@ -16,41 +16,95 @@
 # License along with this library. If not,
 # see <http://www.gnu.org/licenses/>.
 
-from . import fitting, mapping, optimizers
+from . import fitting, mapping, optimizers, potentials
 
 import os
 import os.path
 root_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
 import collections
+import concurrent.futures
+import functools
 import h5py
+import json
+import math
 import numpy as np
-from scipy.optimize import fsolve
+import time
+import warnings
+from scipy import sparse
 
-def find_flat_point(data, init=None):
+def find_flat_point(data, init=None, xtol=1.49012e-08, maxiter=100,
+                    max_halvings=4):
     N = data.ndim
     if init is None:
         init = [(s - 1) / 2 for s in data.shape]
-    init = np.array(init)
+    x = np.array(init, dtype='d')
     # 3rd order fit
-    fitter = fitting.PolyFitter(tuple(3 for i in range(N)))
+    fitter = fitting.get_fitter(tuple(3 for i in range(N)))
     cache = fitting.PolyFitCache(fitter, data)
-    def model(x):
-        return np.array([cache.gradient(i, x) for i in range(N)])
-    return fsolve(model, init)
-
-def find_all_flat_points(all_data, init=None):
+    # The hessian of the fitted polynomial is exact so we use Newton's method
+    # on the gradient, halving the step when it doesn't reduce the gradient.
+    # Since the fit window changes with the position, the fitted gradient
+    # is discontinuous and may not have an exact root. If a few halvings
+    # (or a step below `xtol`) still cannot reduce the gradient,
+    # `x` is as flat as the fit allows and is returned.
+    grad, hess = cache.gradient_hessian(x)
+    residual = np.linalg.norm(grad)
+    for i in range(maxiter):
+        if residual == 0:
+            return x
+        step = np.linalg.lstsq(hess, -grad, rcond=None)[0]
+        tol = xtol * (xtol + np.linalg.norm(x))
+        if np.linalg.norm(step) <= tol:
+            return x + step
+        for j in range(max_halvings + 1):
+            new_x = x + step
+            new_grad, new_hess = cache.gradient_hessian(new_x)
+            new_residual = np.linalg.norm(new_grad)
+            if new_residual < residual:
+                break
+            step = step / 2
+            if np.linalg.norm(step) <= tol:
+                return x
+        else:
+            return x
+        x, grad, hess, residual = new_x, new_grad, new_hess, new_residual
+    warnings.warn("find_flat_point did not converge", RuntimeWarning)
+    return x
+
+def _find_flat_points_chunk(all_data, init):
     N = all_data.ndim
     npoints = all_data.shape[0]
     all_res = np.empty((N - 1, npoints))
-    if init is None:
-        init = [(s - 1) / 2 for s in all_data.shape[1:]]
     for i in range(npoints):
         idx_range = (i,) + tuple(slice(None) for i in range(N - 1))
         init = find_flat_point(all_data[idx_range], init=init)
         all_res[:, i] = init
     return all_res
 
+def find_all_flat_points(all_data, init=None, workers=None, chunk_size=None):
+    """
+    Find the flat point for each slice along the first axis of `all_data`,
+    using the result from the previous slice as the initial guess for the next one.
+
+    With `workers`, the slices are split into chunks (of `chunk_size` slices,
+    one chunk per worker by default) that are solved in parallel
+    in a process pool. The warm start is kept within each chunk
+    and the first slice in each chunk starts from `init`.
+    """
+    npoints = all_data.shape[0]
+    if init is None:
+        init = [(s - 1) / 2 for s in all_data.shape[1:]]
+    if workers is None or workers <= 1:
+        return _find_flat_points_chunk(all_data, init)
+    if chunk_size is None:
+        chunk_size = -(-npoints // workers)
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(_find_flat_points_chunk,
+                                   np.asarray(all_data[i:i + chunk_size]), init)
+                   for i in range(0, npoints, chunk_size)]
+        return np.concatenate([f.result() for f in futures], axis=1)
+
 # EURIQA unit:
 # Unit such that electric potential that creates 1MHz trapping frequency
 # for Yb171 has the form X^2/2,
@@ -98,6 +152,12 @@ class CenterTracker:
         c_lb = ub_idx - xidx
         return y_lb * c_lb + y_ub * c_ub, z_lb * c_lb + z_ub * c_ub
 
+    def get_many(self, xidxs):
+        # Vectorized version of `get`, return (ys, zs)
+        xp = np.arange(self.yz_index.shape[1])
+        return (np.interp(xidxs, xp, self.yz_index[0]),
+                np.interp(xidxs, xp, self.yz_index[1]))
+
 def load_short_map(fname):
     m = np.loadtxt(fname, dtype=str, delimiter=',')
     res = {}
@@ -105,78 +165,133 @@ def load_short_map(fname):
         res[m[i, 0]] = m[i, 1]
     return res
 
-CompensateTerms1 = collections.namedtuple("CompensateTerms1",
-                                          ["dx", "dy", "dz",
-                                           "xy", "yz", "zx",
-                                           "z2", "x2", "x3", "x4"])
+TermSpec = collections.namedtuple("TermSpec", ["name", "derivatives"])
+TermSpec.__doc__ = """
+A term as a linear combination of the derivatives of the potential.
 
-# Terms we care about
-# x, y, z, xy, yz, xz, (z^2 - y^2) / 2, (x^2 - (y^2 + z^2) / 2) / 2, x^3 / 3!, x^4 / 4!
-# Since we care about the symmetry of the x^2 and z^2 term,
-# we actually do need to scale the x, y and z correctly.
-# stride should be in um, voltage should be in V
-def get_compensate_terms1(res, stride):
-    # axis order of fitting result and stride are both is x, y, z
-    raw_x = res[1, 0, 0]
-    raw_y = res[0, 1, 0]
-    raw_z = res[0, 0, 1]
-
-    raw_xy = res[1, 1, 0]
-    raw_yz = res[0, 1, 1]
-    raw_zx = res[1, 0, 1]
-
-    raw_x2 = res[2, 0, 0]
-    raw_y2 = res[0, 2, 0]
-    raw_z2 = res[0, 0, 2]
-
-    raw_x3 = res[3, 0, 0]
-    raw_x4 = res[4, 0, 0]
-
-    scaled_x = raw_x / stride[0]
-    scaled_y = raw_y / stride[1]
-    scaled_z = raw_z / stride[2]
-
-    # We need to divide the xy/yz/zx terms by 2 relative to the x2, y2, z2 terms.
-    # This makes sure that, e.g., the z^2 term is a direct rotation of the
-    # xy/yz/zx terms.
-    scaled_xy = raw_xy / stride[0] / stride[1]
-    scaled_yz = raw_yz / stride[1] / stride[2]
-    scaled_zx = raw_zx / stride[2] / stride[0]
-
-    scaled_x2 = raw_x2 / stride[0]**2 * 2
-    scaled_y2 = raw_y2 / stride[1]**2 * 2
-    scaled_z2 = raw_z2 / stride[2]**2 * 2
-
-    scaled_x3 = raw_x3 / stride[0]**3 * 6
-    scaled_x4 = raw_x4 / stride[0]**4 * 24
-
-    # The two legal quadratic terms are `x^2 - (y^2 + z^2) / 2` and `z^2 - y^2`
-    # which are also orthogonal to each other.
-    # The orthogonal illegal term is `x^2 + y^2 + z^2`.
-    # Here we just need to find the transfermation to go from the taylor expansion
-    # basis to the new basis.
-    # Since the three terms are orthogonal, we can just compute the dot product
-    # with these three terms and apply the correct normalization coefficient.
-    xx = (2 * scaled_x2 - scaled_y2 - scaled_z2) / 3
-    zz = (scaled_z2 - scaled_y2) / 2
+`derivatives` is a tuple of `(order, weight)` pairs, where `order` is the
+`(nx, ny, nz)` derivative order. The derivatives are computed in V/um^n
+(i.e. the polynomial coefficient times the factorials of the orders
+divided by the stride to the power of the orders) and converted to
+EURIQA unit (V/m for the first order derivatives) according to
+the total order `n`, which must be the same for all the derivatives in a term.
+"""
 
+def _euriqa_scale(n):
     # Current units are V/um^n
     # Expected units
     # DX/DY/DZ: V/m
     # XY, YZ, ZX, ZZ, XX: 525 uV / (2.74 um)^2
     # X3: 525 uV / (2.74 um)^3
     # X4: 525 uV / (2.74 um)^4
-    scale_1 = 1e6
-    scale_2 = (l_unit_um**2 / V_unit)
-    scale_3 = (l_unit_um**3 / V_unit)
-    scale_4 = (l_unit_um**4 / V_unit)
-    return CompensateTerms1(scaled_x * scale_1, scaled_y * scale_1, scaled_z * scale_1,
-                            scaled_xy * scale_2, scaled_yz * scale_2,
-                            scaled_zx * scale_2, zz * scale_2,
-                            xx * scale_2, scaled_x3 * scale_3, scaled_x4 * scale_4)
+    if n == 1:
+        return 1e6
+    return l_unit_um**n / V_unit
+
+@functools.lru_cache(maxsize=None)
+def _term_matrix(spec, orders, stride):
+    sizes = tuple(o + 1 for o in orders)
+    rows = []
+    cols = []
+    vals = []
+    for (i, term) in enumerate(spec):
+        total_orders = {sum(order) for (order, weight) in term.derivatives}
+        if len(total_orders) != 1:
+            raise ValueError(f"Term {term.name} mixes derivatives of different orders")
+        scale = _euriqa_scale(total_orders.pop())
+        for (order, weight) in term.derivatives:
+            if any(o > max_o for (o, max_o) in zip(order, orders)):
+                raise ValueError(f"Term {term.name} requires a fit of order {order}")
+            rows.append(i)
+            cols.append(fitting._cartesian_to_linear(sizes, order))
+            factor = fitting.math_prod(math.factorial(o) / s**o
+                                       for (o, s) in zip(order, stride))
+            vals.append(weight * scale * factor)
+    res = sparse.csr_matrix((vals, (rows, cols)),
+                            shape=(len(spec), fitting.math_prod(sizes)))
+    # Merge the duplicated entries so that the matrix can be shared read-only
+    res.sum_duplicates()
+    return res
+
+def term_matrix(spec, orders, stride):
+    """
+    Compile the sequence of `TermSpec` `spec` to the sparse `(nterms_out, nterms)`
+    matrix that maps the fitted coefficients (for a fitter with `orders`)
+    to the terms. `stride` is in um.
+    The matrix is computed once for each `spec`, fitter orders and stride
+    and should not be modified.
+    """
+    return _term_matrix(tuple(TermSpec(term.name, tuple((tuple(int(o) for o in order),
+                                                         float(weight))
+                                                        for (order, weight)
+                                                        in term.derivatives))
+                              for term in spec),
+                        tuple(int(o) for o in orders),
+                        tuple(float(s) for s in stride))
+
+def get_terms_many(spec, fits, orders, stride):
+    """
+    Compute the terms in `spec` for the `(nelectrodes, nterms)` stack
+    of fitted coefficients. Return the `(nterms_out, nelectrodes)` terms.
+    """
+    return term_matrix(spec, orders, stride) @ np.asarray(fits).T
+
+# Terms we care about
+# x, y, z, xy, yz, xz, (z^2 - y^2) / 2, (x^2 - (y^2 + z^2) / 2) / 2, x^3 / 3!, x^4 / 4!
+# Since we care about the symmetry of the x^2 and z^2 term,
+# we actually do need to scale the x, y and z correctly.
+#
+# Since the terms are defined using the derivatives, the xy/yz/zx terms
+# are effectively divided by 2 relative to the x2, y2, z2 terms.
+# This makes sure that, e.g., the z^2 term is a direct rotation of the
+# xy/yz/zx terms.
+#
+# The two legal quadratic terms are `x^2 - (y^2 + z^2) / 2` and `z^2 - y^2`
+# which are also orthogonal to each other.
+# The orthogonal illegal term is `x^2 + y^2 + z^2`.
+# Here we just need to find the transfermation to go from the taylor expansion
+# basis to the new basis.
+# Since the three terms are orthogonal, we can just compute the dot product
+# with these three terms and apply the correct normalization coefficient.
+compensate_terms1_spec = (
+    TermSpec("dx", (((1, 0, 0), 1),)),
+    TermSpec("dy", (((0, 1, 0), 1),)),
+    TermSpec("dz", (((0, 0, 1), 1),)),
+    TermSpec("xy", (((1, 1, 0), 1),)),
+    TermSpec("yz", (((0, 1, 1), 1),)),
+    TermSpec("zx", (((1, 0, 1), 1),)),
+    TermSpec("z2", (((0, 0, 2), 1 / 2), ((0, 2, 0), -1 / 2))),
+    TermSpec("x2", (((2, 0, 0), 2 / 3), ((0, 2, 0), -1 / 3), ((0, 0, 2), -1 / 3))),
+    TermSpec("x3", (((3, 0, 0), 1),)),
+    TermSpec("x4", (((4, 0, 0), 1),)),
+)
+
+CompensateTerms1 = collections.namedtuple("CompensateTerms1",
+                                          [term.name for term
+                                           in compensate_terms1_spec])
+
+# stride should be in um, voltage should be in V
+def get_compensate_terms1(res, stride):
+    # axis order of fitting result and stride are both is x, y, z
+    return CompensateTerms1(*(term_matrix(compensate_terms1_spec, res.orders, stride)
+                              @ res.coefficient))
+
+def compensate_terms_matrix1(orders, stride):
+    """
+    The sparse `(10, nterms)` matrix that maps the fitted coefficients
+    to the terms in `CompensateTerms1` (see `term_matrix`).
+    """
+    return term_matrix(compensate_terms1_spec, orders, stride)
+
+def get_compensate_terms1_many(fits, orders, stride):
+    """
+    Vectorized version of `get_compensate_terms1` for the `(nelectrodes, nterms)`
+    stack of fitted coefficients. Return the `(10, nelectrodes)` terms.
+    """
+    return get_terms_many(compensate_terms1_spec, fits, orders, stride)
 
 def compensate_fitter1(potential, sizes=(129, 5, 5)):
-    fitter = fitting.PolyFitter((4, 2, 2), sizes=sizes)
+    fitter = fitting.get_fitter((4, 2, 2), sizes=sizes)
     return potential.get_cache(fitter)
 
 def get_compensate_coeff1(cache, pos, electrode_min_num=20, electrode_min_dist=350):
@@ -187,15 +302,10 @@ def get_compensate_coeff1(cache, pos, electrode_min_num=20, electrode_min_dist=3
                                          min_dist=electrode_min_dist)
     ele_select = list(ele_select)
     ele_select.sort()
-    fits = [cache.get(e, pos) for e in ele_select]
-
+    fits = cache.get_all(ele_select, pos)
     # Change stride to um in unit
     stride_um = np.array(cache.potential.stride) * 1000
-    nfits = len(fits)
-    coefficient = np.empty((10, nfits))
-    for i in range(nfits):
-        coefficient[:, i] = tuple(get_compensate_terms1(fits[i], stride_um))
-    return ele_select, coefficient
+    return ele_select, get_compensate_terms1_many(fits, cache.fitter.orders, stride_um)
 
 def solve_compensate1(cache, pos, electrode_min_num=20, electrode_min_dist=350):
     ele_select, coefficient = get_compensate_coeff1(
@@ -207,80 +317,37 @@ def solve_compensate1(cache, pos, electrode_min_num=20, electrode_min_dist=350):
                                         X[:, 3], X[:, 4], X[:, 5],
                                         X[:, 6], X[:, 7], X[:, 8], X[:, 9])
 
-CompensateTerms2 = collections.namedtuple("CompensateTerms2",
-                                          ["dx", "dy", "dz",
-                                           "xy", "yz", "zx",
-                                           "z2", "x2", "x3", "x4", "x2z"])
-
 # Terms we care about on pheonix
 # x, y, z, xy, yz, xz, (z^2 - y^2) / 2, (x^2 - (y^2 + z^2) / 2) / 2,
 # x^3 / 3!, x^4 / 4!, x^2z / 2
 # Compared to HOA, we are able to compensate for x^2z due to the outer electrodes.
+compensate_terms2_spec = compensate_terms1_spec + (
+    TermSpec("x2z", (((2, 0, 1), 1),)),
+)
+
+CompensateTerms2 = collections.namedtuple("CompensateTerms2",
+                                          [term.name for term
+                                           in compensate_terms2_spec])
+
 # stride should be in um, voltage should be in V
 def get_compensate_terms2(res, stride):
     # axis order of fitting result and stride are both is x, y, z
-    raw_x = res[1, 0, 0]
-    raw_y = res[0, 1, 0]
-    raw_z = res[0, 0, 1]
-
-    raw_xy = res[1, 1, 0]
-    raw_yz = res[0, 1, 1]
-    raw_zx = res[1, 0, 1]
-
-    raw_x2 = res[2, 0, 0]
-    raw_y2 = res[0, 2, 0]
-    raw_z2 = res[0, 0, 2]
-
-    raw_x3 = res[3, 0, 0]
-    raw_x4 = res[4, 0, 0]
-
-    raw_x2z = res[2, 0, 1]
-
-    scaled_x = raw_x / stride[0]
-    scaled_y = raw_y / stride[1]
-    scaled_z = raw_z / stride[2]
-
-    # We need to divide the xy/yz/zx terms by 2 relative to the x2, y2, z2 terms.
-    # This makes sure that, e.g., the z^2 term is a direct rotation of the
-    # xy/yz/zx terms.
-    scaled_xy = raw_xy / stride[0] / stride[1]
-    scaled_yz = raw_yz / stride[1] / stride[2]
-    scaled_zx = raw_zx / stride[2] / stride[0]
-
-    scaled_x2 = raw_x2 / stride[0]**2 * 2
-    scaled_y2 = raw_y2 / stride[1]**2 * 2
-    scaled_z2 = raw_z2 / stride[2]**2 * 2
-
-    scaled_x3 = raw_x3 / stride[0]**3 * 6
-    scaled_x4 = raw_x4 / stride[0]**4 * 24
-
-    scaled_x2z = raw_x2z / stride[0]**2 / stride[2] * 2
-
-    # The two legal quadratic terms are `x^2 - (y^2 + z^2) / 2` and `z^2 - y^2`
-    # which are also orthogonal to each other.
-    # The orthogonal illegal term is `x^2 + y^2 + z^2`.
-    # Here we just need to find the transfermation to go from the taylor expansion
-    # basis to the new basis.
-    # Since the three terms are orthogonal, we can just compute the dot product
-    # with these three terms and apply the correct normalization coefficient.
-    xx = (2 * scaled_x2 - scaled_y2 - scaled_z2) / 3
-    zz = (scaled_z2 - scaled_y2) / 2
-
-    # Current units are V/um^n
-    # Expected units
-    # DX/DY/DZ: V/m
-    # XY, YZ, ZX, ZZ, XX: 525 uV / (2.74 um)^2
-    # X3: 525 uV / (2.74 um)^3
-    # X4: 525 uV / (2.74 um)^4
-    scale_1 = 1e6
-    scale_2 = (l_unit_um**2 / V_unit)
-    scale_3 = (l_unit_um**3 / V_unit)
-    scale_4 = (l_unit_um**4 / V_unit)
-    return CompensateTerms2(scaled_x * scale_1, scaled_y * scale_1, scaled_z * scale_1,
-                            scaled_xy * scale_2, scaled_yz * scale_2,
-                            scaled_zx * scale_2, zz * scale_2,
-                            xx * scale_2, scaled_x3 * scale_3, scaled_x4 * scale_4,
-                            scaled_x2z * scale_3)
+    return CompensateTerms2(*(term_matrix(compensate_terms2_spec, res.orders, stride)
+                              @ res.coefficient))
+
+def compensate_terms_matrix2(orders, stride):
+    """
+    The sparse `(11, nterms)` matrix that maps the fitted coefficients
+    to the terms in `CompensateTerms2` (see `term_matrix`).
+    """
+    return term_matrix(compensate_terms2_spec, orders, stride)
+
+def get_compensate_terms2_many(fits, orders, stride):
+    """
+    Vectorized version of `get_compensate_terms2` for the `(nelectrodes, nterms)`
+    stack of fitted coefficients. Return the `(11, nelectrodes)` terms.
+    """
+    return get_terms_many(compensate_terms2_spec, fits, orders, stride)
 
 def get_compensate_coeff2(cache, pos, electrode_min_num=20, electrode_min_dist=350):
     # pos is in xyz index
@@ -290,15 +357,10 @@ def get_compensate_coeff2(cache, pos, electrode_min_num=20, electrode_min_dist=3
                                          min_dist=electrode_min_dist)
     ele_select = list(ele_select)
     ele_select.sort()
-    fits = [cache.get(e, pos) for e in ele_select]
-
+    fits = cache.get_all(ele_select, pos)
     # Change stride to um in unit
     stride_um = np.array(cache.potential.stride) * 1000
-    nfits = len(fits)
-    coefficient = np.empty((11, nfits))
-    for i in range(nfits):
-        coefficient[:, i] = tuple(get_compensate_terms2(fits[i], stride_um))
-    return ele_select, coefficient
+    return ele_select, get_compensate_terms2_many(fits, cache.fitter.orders, stride_um)
 
 def solve_compensate2(cache, pos, electrode_min_num=20, electrode_min_dist=350):
     ele_select, coefficient = get_compensate_coeff2(
@@ -312,5 +374,347 @@ def solve_compensate2(cache, pos, electrode_min_num=20, electrode_min_dist=350):
                                         X[:, 10])
 
 def compensate_fitter3(potential, sizes=(77, 5, 5)):
-    fitter = fitting.PolyFitter((8, 2, 2), sizes=sizes)
+    fitter = fitting.get_fitter((8, 2, 2), sizes=sizes)
     return potential.get_cache(fitter)
+
+CompensateSweep = collections.namedtuple("CompensateSweep",
+                                         ["xs", "positions", "electrodes",
+                                          "terms", "voltages"])
+
+_compensate_term_sets = {1: (CompensateTerms1, get_compensate_terms1_many),
+                         2: (CompensateTerms2, get_compensate_terms2_many)}
+
+def sweep_compensate(cache, xs, centers, terms=1, electrode_min_num=20,
+                     electrode_min_dist=350):
+    """
+    Compute the compensation solutions (`solve_compensate1` with `terms=1`
+    or `solve_compensate2` with `terms=2`) at the RF center for each of the
+    x positions `xs` (in um). `centers` is the `CenterTracker` for the trap.
+
+    Positions that use the same set of electrodes are fitted together
+    (see `FitCache.get_all_many`) so that each fit window is only fitted once.
+    Return a `CompensateSweep` with
+    `xs`, the `(npositions, 3)` `positions` in xyz index,
+    the `(npositions, nelectrodes)` boolean mask of the `electrodes` used
+    for each position, the names of the `terms`, and the
+    `(npositions, nterms, nelectrodes)` `voltages` (zero for the electrodes
+    not used) for all the electrodes in the potential.
+    """
+    term_type, get_terms = _compensate_term_sets[terms]
+    nterms = len(term_type._fields)
+    potential = cache.potential
+    # Change stride to um in unit
+    stride_um = np.array(potential.stride) * 1000
+    xs = np.asarray(xs, dtype='d')
+    npositions = len(xs)
+    xidxs = potential.x_axis_to_index(xs / 1000)
+    positions = np.stack([xidxs, *centers.get_many(xidxs)], axis=1)
+
+    electrodes = np.zeros((npositions, potential.electrodes), dtype=bool)
+    groups = {}
+    for i in range(npositions):
+        x_coord = potential.x_index_to_axis(xidxs[i]) * 1000
+        ele_select = mapping.find_electrodes(potential.electrode_index, x_coord,
+                                             min_num=electrode_min_num,
+                                             min_dist=electrode_min_dist)
+        ele_select = sorted(ele_select)
+        electrodes[i, ele_select] = True
+        groups.setdefault(tuple(ele_select), []).append(i)
+
+    voltages = np.zeros((npositions, nterms, potential.electrodes))
+    targets = np.eye(nterms)
+    for (ele_select, idxs) in groups.items():
+        all_fits = cache.get_all_many(ele_select, positions[idxs])
+        for (i, fits) in zip(idxs, all_fits):
+            coefficient = get_terms(fits, cache.fitter.orders, stride_um)
+            X = optimizers.optimize_minmax(coefficient, targets)
+            voltages[i][:, list(ele_select)] = X.T
+    return CompensateSweep(xs, positions, electrodes, term_type._fields, voltages)
+
+def compensate_filename(prefix_dir, x):
+    # File name for the solution at `x` (in um) in `prefix_dir`.
+    # The shortest representation that round-trips, so that distinct positions
+    # never share a file (integers are written without the decimal point).
+    return os.path.join(prefix_dir,
+                        f"{np.format_float_positional(x, trim='-')}.h5")
+
+def save_compensate_solution(filename, electrode_names, sweep, i):
+    """
+    Save the `i`th solution in the `CompensateSweep` `sweep` to `filename`
+    (one file per position, with the names of all the electrodes,
+    the indices of the electrodes used and one dataset per term).
+    The file is written to a temporary name first so that an interrupted
+    write never leaves a partial file behind.
+    """
+    eles = np.nonzero(sweep.electrodes[i])[0]
+    tmpname = filename + ".tmp"
+    with h5py.File(tmpname, 'w') as fh:
+        fh.create_dataset("electrode_names", data=json.dumps(electrode_names))
+        fh.create_dataset("electrodes", data=eles)
+        g = fh.create_group("solutions")
+        for (j, name) in enumerate(sweep.terms):
+            g.create_dataset(name, data=sweep.voltages[i, j, eles])
+    os.replace(tmpname, filename)
+
+def print_progress(ndone, ntotal, elapsed):
+    rate = ndone / elapsed if elapsed > 0 else 0.0
+    print(f"{ndone}/{ntotal} positions, {rate:.2f} positions/s")
+
+# Per-process state of the workers for `generate_compensate`
+_compensate_worker = None
+
+def _compensate_worker_init(handle, fitter, cache_kwargs, centers, kwargs):
+    global _compensate_worker
+    potential = potentials.Potential.from_shared_memory(handle)
+    _compensate_worker = (potential.get_cache(fitter, **cache_kwargs), centers, kwargs)
+
+def _compensate_worker_run(xs):
+    cache, centers, kwargs = _compensate_worker
+    return sweep_compensate(cache, xs, centers, **kwargs)
+
+def generate_compensate(potential, fitter, centers, xs, output, terms=1,
+                        electrode_min_num=20, electrode_min_dist=350,
+                        workers=None, chunk_size=8, progress=print_progress,
+                        cache_kwargs=None):
+    """
+    Compute the compensation solutions (see `sweep_compensate`) for the x positions
+    `xs` (in um) and save them in `output`, which is either a `SolutionStore`
+    (that must contain all of `xs`) or a directory to save the results in
+    with one file per position (see `save_compensate_solution`).
+
+    The positions are split into chunks of `chunk_size` neighbouring positions
+    that are solved in a pool of `workers` processes
+    (one per core if `None` and in the current process if `1`).
+    The workers access the potential data through shared memory, and if `potential`
+    is a `Potential` rather than a `SharedPotential` handle,
+    it is published with `to_shared_memory` first. The caller is responsible
+    for releasing the shared memory once it is no longer needed.
+
+    The results are saved in the order of `xs`. Positions that already
+    have a result are skipped so that an interrupted run can be resumed.
+    `progress(ndone, ntotal, elapsed)` is called after each chunk is saved.
+
+    `cache_kwargs` are passed to `Potential.get_cache` to create the fit cache
+    in each worker (e.g. `dtype`, `max_entries` or `max_bytes`).
+    A fit `store` can only be used with `workers=1` since the HDF5 file
+    of a `FitStore` cannot be opened for writing by several processes at once.
+    Return the number of positions computed.
+    """
+    if cache_kwargs is None:
+        cache_kwargs = {}
+    if cache_kwargs.get("store") is not None and workers != 1:
+        raise ValueError("A fit store can only be used with workers=1")
+    if isinstance(potential, potentials.SharedPotential):
+        handle = potential
+        electrode_names = handle.electrode_names
+        potential = None
+    else:
+        handle = None
+        electrode_names = potential.electrode_names
+    kwargs = dict(terms=terms, electrode_min_num=electrode_min_num,
+                  electrode_min_dist=electrode_min_dist)
+    if isinstance(output, SolutionStore):
+        if output.electrode_names != electrode_names:
+            raise ValueError("Electrodes of the solution store do not match")
+        for x in xs:
+            if not output.contains(x):
+                raise ValueError(f"Position {x} is not in the solution store")
+        xs = [x for x in xs if not output.has(x)]
+    else:
+        os.makedirs(output, exist_ok=True)
+        xs = [x for x in xs if not os.path.exists(compensate_filename(output, x))]
+    ntotal = len(xs)
+    chunks = [xs[i:i + chunk_size] for i in range(0, ntotal, chunk_size)]
+    start_time = time.monotonic()
+    ndone = 0
+
+    def save(sweep):
+        nonlocal ndone
+        if isinstance(output, SolutionStore):
+            output.write(sweep)
+        else:
+            for (i, x) in enumerate(sweep.xs):
+                save_compensate_solution(compensate_filename(output, x),
+                                         electrode_names, sweep, i)
+        ndone += len(sweep.xs)
+        if progress is not None:
+            progress(ndone, ntotal, time.monotonic() - start_time)
+
+    if workers == 1:
+        if potential is None:
+            potential = potentials.Potential.from_shared_memory(handle)
+        with potential.get_cache(fitter, **cache_kwargs) as cache:
+            for chunk in chunks:
+                save(sweep_compensate(cache, np.array(chunk), centers, **kwargs))
+        return ntotal
+    if handle is None:
+        handle = potential.to_shared_memory()
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_compensate_worker_init,
+            initargs=(handle, fitter, cache_kwargs, centers, kwargs)) as executor:
+        # `map` returns the results in order
+        for sweep in executor.map(_compensate_worker_run,
+                                  [np.array(chunk) for chunk in chunks]):
+            save(sweep)
+    return ntotal
+
+class SolutionStore:
+    """
+    Compensation solutions for a set of x positions in a single HDF5 file.
+
+    The file contains the names of all the electrodes (`electrode_names`)
+    and of the `terms` (both as JSON), the x positions (`xs`, in um)
+    and for each position, the position in xyz index (`positions`),
+    the mask of the `electrodes` used, the `(nterms, nelectrodes)` `voltages`
+    (zero for the electrodes not used) and whether the solution has been
+    computed (`done`). The solutions can be written incrementally
+    in any order with `write`.
+    """
+    def __init__(self, filename, mode='r'):
+        self.file = h5py.File(filename, mode)
+        self.electrode_names = json.loads(self.file["electrode_names"][()])
+        self.terms = tuple(json.loads(self.file["terms"][()]))
+        self.xs = self.file["xs"][()]
+        self.done = self.file["done"][()]
+        self.__index = {float(x): i for (i, x) in enumerate(self.xs)}
+
+    @classmethod
+    def create(cls, filename, xs, electrode_names, terms):
+        """
+        Create a new store for the x positions `xs` (in um)
+        with no solutions computed.
+        """
+        xs = np.asarray(xs, dtype='d')
+        if len(np.unique(xs)) != len(xs):
+            raise ValueError("Duplicated positions")
+        npositions = len(xs)
+        nterms = len(terms)
+        nelectrodes = len(electrode_names)
+        with h5py.File(filename, 'w') as fh:
+            fh.create_dataset("electrode_names", data=json.dumps(electrode_names))
+            fh.create_dataset("terms", data=json.dumps(list(terms)))
+            fh.create_dataset("xs", data=xs)
+            fh.create_dataset("done", shape=(npositions,), dtype=bool)
+            fh.create_dataset("positions", shape=(npositions, 3), dtype='d',
+                              fillvalue=np.nan)
+            chunk_size = max(min(npositions, 16), 1)
+            fh.create_dataset("electrodes", shape=(npositions, nelectrodes),
+                              dtype=bool, chunks=(chunk_size, nelectrodes))
+            fh.create_dataset("voltages", shape=(npositions, nterms, nelectrodes),
+                              dtype='d', chunks=(chunk_size, nterms, nelectrodes))
+        return cls(filename, 'r+')
+
+    @classmethod
+    def open_or_create(cls, filename, xs, electrode_names, terms):
+        """
+        Open the existing store in `filename` for writing if there is one
+        (which must have been created with the same parameters)
+        or create a new one otherwise.
+        """
+        if not os.path.exists(filename):
+            return cls.create(filename, xs, electrode_names, terms)
+        self = cls(filename, 'r+')
+        if (self.electrode_names != electrode_names or
+            self.terms != tuple(terms) or
+            not np.array_equal(self.xs, np.asarray(xs, dtype='d'))):
+            self.close()
+            raise ValueError(f"Solution store {filename} does not match")
+        return self
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def index(self, x):
+        return self.__index[float(x)]
+
+    def contains(self, x):
+        return float(x) in self.__index
+
+    def has(self, x):
+        idx = self.__index.get(float(x))
+        return idx is not None and bool(self.done[idx])
+
+    def write(self, sweep):
+        """
+        Save the solutions in the `CompensateSweep` `sweep`.
+        """
+        if tuple(sweep.terms) != self.terms:
+            raise ValueError("Terms of the solutions do not match")
+        idxs = np.array([self.index(x) for x in sweep.xs], dtype=np.int64)
+        # HDF5 requires the indices to be increasing
+        order = np.argsort(idxs)
+        idxs = idxs[order]
+        self.file["positions"][idxs] = np.asarray(sweep.positions)[order]
+        self.file["electrodes"][idxs] = np.asarray(sweep.electrodes)[order]
+        self.file["voltages"][idxs] = np.asarray(sweep.voltages)[order]
+        self.done[idxs] = True
+        self.file["done"][idxs] = True
+        self.file.flush()
+
+    def read(self, sel=slice(None)):
+        """
+        Read the solutions for the positions selected by `sel`
+        (a slice or an increasing array of position indices, all positions by default)
+        as a `CompensateSweep`. Positions that haven't been computed
+        have `NaN` positions and no electrodes.
+        """
+        return CompensateSweep(self.xs[sel], self.file["positions"][sel],
+                               self.file["electrodes"][sel], self.terms,
+                               self.file["voltages"][sel])
+
+    def get(self, x):
+        """
+        Return the electrodes used at `x` and a dict of the voltages for each term
+        in the same format as the files written by `save_compensate_solution`.
+        """
+        idx = self.index(x)
+        eles = np.nonzero(self.file["electrodes"][idx])[0]
+        voltages = self.file["voltages"][idx]
+        return eles, {name: voltages[i, eles] for (i, name) in enumerate(self.terms)}
+
+def convert_compensate_dir(prefix_dir, filename):
+    """
+    Convert the solutions saved in `prefix_dir` with one file per position
+    (see `save_compensate_solution`) to a `SolutionStore` in `filename`.
+    """
+    files = {}
+    for name in os.listdir(prefix_dir):
+        base, ext = os.path.splitext(name)
+        if ext != ".h5":
+            continue
+        files[float(base)] = os.path.join(prefix_dir, name)
+    xs = sorted(files)
+    if not xs:
+        raise ValueError(f"No solution found in {prefix_dir}")
+    with h5py.File(files[xs[0]], 'r') as fh:
+        electrode_names = json.loads(fh["electrode_names"][()])
+        names = set(fh["solutions"].keys())
+    # Keep the terms in the same order as the known term sets
+    for (term_type, _) in _compensate_term_sets.values():
+        if set(term_type._fields) == names:
+            terms = term_type._fields
+            break
+    else:
+        terms = tuple(sorted(names))
+    npositions = len(xs)
+    nelectrodes = len(electrode_names)
+    electrodes = np.zeros((npositions, nelectrodes), dtype=bool)
+    voltages = np.zeros((npositions, len(terms), nelectrodes))
+    for (i, x) in enumerate(xs):
+        with h5py.File(files[x], 'r') as fh:
+            if json.loads(fh["electrode_names"][()]) != electrode_names:
+                raise ValueError(f"Electrodes in {files[x]} do not match")
+            eles = fh["electrodes"][()]
+            electrodes[i, eles] = True
+            for (j, name) in enumerate(terms):
+                voltages[i, j, eles] = fh["solutions"][name][()]
+    positions = np.full((npositions, 3), np.nan)
+    with SolutionStore.create(filename, xs, electrode_names, terms) as store:
+        store.write(CompensateSweep(np.array(xs), positions, electrodes,
+                                    terms, voltages))